@@ -0,0 +1,348 @@
+"""
+Minimal D-Bus client: method calls over a unix socket with unix fd passing,
+without python-dbus or GLib.
+
+The system bus is taken from DBUS_SYSTEM_BUS_ADDRESS when set, so tools
+built on this can be pointed at a stand-in service for testing.
+
+This module is part of BredOS-Tools, licenced under the GPL-3.0 licence.
+
+Bill Sideris <bill88t@bredos.org>
+"""
+
+import os
+import array
+import socket
+import struct
+from urllib.parse import unquote
+
+SYSTEM_BUS = "unix:path=/run/dbus/system_bus_socket"
+MAX_FDS = 16
+
+METHOD_CALL = 1
+METHOD_RETURN = 2
+ERROR = 3
+SIGNAL = 4
+
+# Header field codes and their types
+FIELD_PATH = 1
+FIELD_INTERFACE = 2
+FIELD_MEMBER = 3
+FIELD_ERROR_NAME = 4
+FIELD_REPLY_SERIAL = 5
+FIELD_DESTINATION = 6
+FIELD_SIGNATURE = 8
+FIELD_UNIX_FDS = 9
+FIELD_TYPES = {1: "o", 2: "s", 3: "s", 4: "s", 5: "u", 6: "s", 7: "s", 8: "g", 9: "u"}
+
+ALIGNMENT = {"y": 1, "g": 1, "v": 1, "n": 2, "q": 2, "(": 8, "x": 8, "t": 8, "d": 8}
+FIXED = {"y": "B", "b": "I", "n": "h", "q": "H", "i": "i", "u": "I", "h": "I"}
+FIXED.update(x="q", t="Q", d="d")
+
+
+class DBusError(Exception):
+    def __init__(self, name: str, message: str = "") -> None:
+        super().__init__(f"{name}: {message}" if message else name)
+        self.name = name
+
+
+def system_bus_address() -> str:
+    return os.environ.get("DBUS_SYSTEM_BUS_ADDRESS") or SYSTEM_BUS
+
+
+def parse_address(address: str) -> list:
+    """
+    Socket addresses of the unix transports in a D-Bus address string.
+    """
+    addresses = []
+    for entry in address.split(";"):
+        transport, _, params = entry.partition(":")
+        if transport != "unix":
+            continue
+        keys = dict(p.partition("=")[::2] for p in params.split(",") if p)
+        if "path" in keys:
+            addresses.append(unquote(keys["path"]))
+        elif "abstract" in keys:
+            addresses.append("\0" + unquote(keys["abstract"]))
+    return addresses
+
+
+def split_signature(signature: str) -> list:
+    """
+    The complete types of a signature, "sa(yv)u" gives ["s", "a(yv)", "u"].
+    """
+    types = []
+    i = 0
+    while i < len(signature):
+        start = i
+        while signature[i] == "a":
+            i += 1
+        if signature[i] in "({":
+            depth = 0
+            while True:
+                depth += signature[i] in "({"
+                depth -= signature[i] in ")}"
+                i += 1
+                if not depth:
+                    break
+        else:
+            i += 1
+        types.append(signature[start:i])
+    return types
+
+
+def alignment(sig: str) -> int:
+    return ALIGNMENT.get(sig[0], 4) if sig[0] != "{" else 8
+
+
+def marshal(buf: bytearray, sig: str, value, order: str = "<") -> None:
+    """
+    Append value, of the single complete type sig, to buf.
+    """
+    buf += b"\0" * (-len(buf) % alignment(sig))
+    code = sig[0]
+    if code in FIXED:
+        buf += struct.pack(order + FIXED[code], value)
+    elif code in "so":
+        data = value.encode()
+        buf += struct.pack(order + "I", len(data)) + data + b"\0"
+    elif code == "g":
+        buf += struct.pack("B", len(value)) + value.encode() + b"\0"
+    elif code == "v":
+        inner, inner_value = value
+        marshal(buf, "g", inner, order)
+        marshal(buf, inner, inner_value, order)
+    elif code == "a":
+        length_at = len(buf)
+        buf += b"\0\0\0\0"
+        buf += b"\0" * (-len(buf) % alignment(sig[1:]))
+        start = len(buf)
+        for item in value:
+            marshal(buf, sig[1:], item, order)
+        struct.pack_into(order + "I", buf, length_at, len(buf) - start)
+    elif code in "({":
+        for member, item in zip(split_signature(sig[1:-1]), value):
+            marshal(buf, member, item, order)
+    else:
+        raise ValueError(f"cannot marshal type '{sig}'")
+
+
+def unmarshal(data: bytes, offset: int, sig: str, order: str = "<") -> tuple:
+    """
+    Read one value of the complete type sig, returns (value, new offset).
+    """
+    offset += -offset % alignment(sig)
+    code = sig[0]
+    if code in FIXED:
+        fmt = order + FIXED[code]
+        value = struct.unpack_from(fmt, data, offset)[0]
+        return (bool(value) if code == "b" else value), offset + struct.calcsize(fmt)
+    if code in "so":
+        length = struct.unpack_from(order + "I", data, offset)[0]
+        start = offset + 4
+        return data[start : start + length].decode(), start + length + 1
+    if code == "g":
+        length = data[offset]
+        return data[offset + 1 : offset + 1 + length].decode(), offset + length + 2
+    if code == "v":
+        inner, offset = unmarshal(data, offset, "g", order)
+        value, offset = unmarshal(data, offset, inner, order)
+        return (inner, value), offset
+    if code == "a":
+        length = struct.unpack_from(order + "I", data, offset)[0]
+        offset += 4
+        offset += -offset % alignment(sig[1:])
+        end = offset + length
+        items = []
+        while offset < end:
+            item, offset = unmarshal(data, offset, sig[1:], order)
+            items.append(item)
+        if sig[1] == "{":
+            return dict(items), offset
+        return items, offset
+    if code in "({":
+        items = []
+        for member in split_signature(sig[1:-1]):
+            item, offset = unmarshal(data, offset, member, order)
+            items.append(item)
+        return tuple(items), offset
+    raise ValueError(f"cannot unmarshal type '{sig}'")
+
+
+def build_message(
+    kind: int, serial: int, fields: dict, signature: str = "", args=(), flags: int = 0
+) -> bytes:
+    body = bytearray()
+    for sig, value in zip(split_signature(signature), args):
+        marshal(body, sig, value)
+    if signature:
+        fields = {**fields, FIELD_SIGNATURE: signature}
+    header = bytearray(b"l" + bytes((kind, flags, 1)))
+    header += struct.pack("<II", len(body), serial)
+    marshal(
+        header,
+        "a(yv)",
+        [(code, (FIELD_TYPES[code], value)) for code, value in fields.items()],
+    )
+    header += b"\0" * (-len(header) % 8)
+    return bytes(header + body)
+
+
+def parse_message(data: bytes) -> tuple | None:
+    """
+    (kind, serial, fields, body values, size) of the first message in data,
+    None while it is incomplete.
+    """
+    if len(data) < 16:
+        return None
+    order = "<" if data[:1] == b"l" else ">"
+    body_length, serial, fields_length = struct.unpack_from(order + "III", data, 4)
+    body_at = 16 + fields_length + (-(16 + fields_length) % 8)
+    size = body_at + body_length
+    if len(data) < size:
+        return None
+    raw, _ = unmarshal(data, 12, "a(yv)", order)
+    fields = {code: value for code, (_, value) in raw}
+    values = []
+    offset = body_at
+    for sig in split_signature(fields.get(FIELD_SIGNATURE, "")):
+        value, offset = unmarshal(data[:size], offset, sig, order)
+        values.append(value)
+    return data[1], serial, fields, values, size
+
+
+class Connection:
+    """
+    An authenticated bus connection that can call methods and receive the
+    unix fds they return.
+    """
+
+    def __init__(self, address: str | None = None) -> None:
+        address = address or system_bus_address()
+        self.sock = None
+        errors = []
+        for target in parse_address(address):
+            sock = socket.socket(
+                socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_CLOEXEC
+            )
+            try:
+                sock.connect(target)
+            except OSError as e:
+                sock.close()
+                errors.append(e)
+                continue
+            self.sock = sock
+            break
+        if self.sock is None:
+            raise errors[0] if errors else OSError(f"no usable address in '{address}'")
+        self.serial = 0
+        self.buffer = b""
+        self.fds = []
+        try:
+            self.authenticate()
+            (self.name,), _ = self.call(
+                "org.freedesktop.DBus",
+                "/org/freedesktop/DBus",
+                "org.freedesktop.DBus",
+                "Hello",
+            )
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self) -> "Connection":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def authenticate(self) -> None:
+        uid = str(os.getuid()).encode().hex()
+        self.sock.sendall(b"\0AUTH EXTERNAL " + uid.encode() + b"\r\n")
+        if not self.auth_line().startswith(b"OK "):
+            raise OSError("D-Bus authentication failed")
+        self.sock.sendall(b"NEGOTIATE_UNIX_FD\r\n")
+        if not self.auth_line().startswith(b"AGREE_UNIX_FD"):
+            raise OSError("D-Bus peer does not pass unix fds")
+        self.sock.sendall(b"BEGIN\r\n")
+
+    def auth_line(self) -> bytes:
+        while b"\r\n" not in self.buffer:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise OSError("D-Bus connection closed during authentication")
+            self.buffer += chunk
+        line, _, self.buffer = self.buffer.partition(b"\r\n")
+        return line
+
+    def receive(self) -> tuple:
+        """
+        The next message with the fds that came with it.
+        """
+        while True:
+            message = parse_message(self.buffer)
+            if message is not None:
+                kind, serial, fields, values, size = message
+                self.buffer = self.buffer[size:]
+                count = fields.get(FIELD_UNIX_FDS, 0)
+                fds, self.fds = self.fds[:count], self.fds[count:]
+                return kind, serial, fields, values, fds
+            ancillary = socket.CMSG_SPACE(MAX_FDS * array.array("i").itemsize)
+            data, anc, _, _ = self.sock.recvmsg(65536, ancillary)
+            if not data:
+                raise OSError("D-Bus connection closed")
+            for level, kind, payload in anc:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds = array.array("i")
+                    fds.frombytes(payload[: len(payload) - len(payload) % fds.itemsize])
+                    self.fds += list(fds)
+            self.buffer += data
+
+    def call(
+        self,
+        destination: str,
+        path: str,
+        interface: str,
+        member: str,
+        signature: str = "",
+        args=(),
+    ) -> tuple:
+        """
+        Call a method and wait for its reply, returns (values, fds).
+        Error replies raise DBusError.
+        """
+        self.serial += 1
+        serial = self.serial
+        fields = {
+            FIELD_PATH: path,
+            FIELD_INTERFACE: interface,
+            FIELD_MEMBER: member,
+            FIELD_DESTINATION: destination,
+        }
+        self.sock.sendall(build_message(METHOD_CALL, serial, fields, signature, args))
+        while True:
+            kind, _, fields, values, fds = self.receive()
+            if fields.get(FIELD_REPLY_SERIAL) != serial:
+                # Signals such as NameAcquired, or replies nobody waits for
+                for fd in fds:
+                    os.close(fd)
+                continue
+            if kind == ERROR:
+                for fd in fds:
+                    os.close(fd)
+                raise DBusError(
+                    fields.get(FIELD_ERROR_NAME, "org.freedesktop.DBus.Error.Failed"),
+                    values[0] if values and isinstance(values[0], str) else "",
+                )
+            return values, fds
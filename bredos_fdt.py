@@ -0,0 +1,768 @@
+"""
+Flattened device tree (DTB/DTBO) reader and writer.
+
+Blobs are parsed zero-copy over mmap/memoryview, property values stay views
+into the blob for as long as the FDT is open.
+
+This module is part of BredOS-Tools, licenced under the GPL-3.0 licence.
+
+Bill Sideris <bill88t@bredos.org>
+"""
+
+import os
+import mmap
+import struct
+
+FDT_MAGIC = 0xD00DFEED
+FDT_BEGIN_NODE = 0x1
+FDT_END_NODE = 0x2
+FDT_PROP = 0x3
+FDT_NOP = 0x4
+FDT_END = 0x9
+
+FDT_VERSION = 17
+FDT_LAST_COMP_VERSION = 16
+
+HEADER = struct.Struct(">10I")
+RESERVE = struct.Struct(">QQ")
+TOKEN = struct.Struct(">I")
+PROP = struct.Struct(">II")
+
+PRINTABLE = frozenset(range(0x20, 0x7F)) | frozenset(b"\a\b\t\n\v\f\r")
+ESCAPES = {
+    ord("\a"): "\\a",
+    ord("\b"): "\\b",
+    ord("\t"): "\\t",
+    ord("\n"): "\\n",
+    ord("\v"): "\\v",
+    ord("\f"): "\\f",
+    ord("\r"): "\\r",
+    ord("\\"): "\\\\",
+    ord('"'): '\\"',
+}
+
+
+class FDTError(ValueError):
+    pass
+
+
+def _align(offset: int, size: int = 4) -> int:
+    return (offset + size - 1) & ~(size - 1)
+
+
+def is_string_list(value: bytes | memoryview) -> bool:
+    """
+    Same heuristic dtc uses to decide a property holds strings.
+    """
+    if not value or value[-1] != 0 or value[0] == 0:
+        return False
+    previous = None
+    for byte in value:
+        if byte == 0 and previous == 0:
+            return False
+        if byte and byte not in PRINTABLE:
+            return False
+        previous = byte
+    return True
+
+
+def cells(value: bytes | memoryview) -> tuple:
+    """
+    Decode a property value as big-endian 32-bit cells.
+    """
+    return struct.unpack(f">{len(value) // 4}I", value[: len(value) & ~3])
+
+
+def strings(value: bytes | memoryview) -> list:
+    """
+    Decode a property value as a list of NUL terminated strings.
+    """
+    return bytes(value).rstrip(b"\0").decode(errors="replace").split("\0")
+
+
+def format_value(value: bytes | memoryview) -> str:
+    """
+    Format a property value the way dtc writes it in DTS.
+    """
+    if not len(value):
+        return ""
+    if is_string_list(value):
+        return ", ".join(
+            '"' + "".join(ESCAPES.get(ord(c), c) for c in s) + '"'
+            for s in strings(value)
+        )
+    if len(value) % 4 == 0:
+        return "<" + " ".join(f"0x{c:02x}" for c in cells(value)) + ">"
+    return "[" + " ".join(f"{b:02x}" for b in bytes(value)) + "]"
+
+
+class Node:
+    """
+    A device tree node, properties and children keep insertion order.
+    """
+
+    __slots__ = ("name", "parent", "props", "children")
+
+    def __init__(self, name: str = "", parent: "Node | None" = None) -> None:
+        self.name = name
+        self.parent = parent
+        self.props = {}
+        self.children = {}
+
+    def __repr__(self) -> str:
+        return f"<Node {self.path}>"
+
+    @property
+    def path(self) -> str:
+        if self.parent is None:
+            return "/"
+        parent = self.parent.path
+        return (parent if parent != "/" else "") + "/" + self.name
+
+    def add(self, name: str) -> "Node":
+        """
+        Return the named child, creating it if needed.
+        """
+        child = self.children.get(name)
+        if child is None:
+            child = self.children[name] = Node(name, self)
+        return child
+
+    def walk(self):
+        """
+        Yield this node and all its descendants, depth first.
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children.values()))
+
+    def find(self, path: str) -> "Node | None":
+        node = self
+        for part in path.strip("/").split("/"):
+            if not part:
+                continue
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+
+class FDT:
+    """
+    An in-memory flattened device tree.
+    """
+
+    def __init__(
+        self,
+        root: Node | None = None,
+        memreserve: list | None = None,
+        boot_cpuid: int = 0,
+    ) -> None:
+        self.root = root if root is not None else Node()
+        self.memreserve = memreserve if memreserve is not None else []
+        self.boot_cpuid = boot_cpuid
+        self._mmap = None
+        self._view = None
+
+    def __enter__(self) -> "FDT":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Release the underlying blob, values taken from it become invalid.
+        """
+        if self._view is None:
+            return
+        for node in self.root.walk():
+            for value in node.props.values():
+                if isinstance(value, memoryview):
+                    value.release()
+        self._view.release()
+        self._view = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def detach(self) -> None:
+        """
+        Copy every property out of the blob so it can be closed safely.
+        """
+        for node in self.root.walk():
+            for name, value in node.props.items():
+                node.props[name] = bytes(value)
+        self.close()
+
+    def find(self, path: str) -> Node | None:
+        return self.root.find(path)
+
+    def walk(self):
+        return self.root.walk()
+
+    @classmethod
+    def open(cls, path: str) -> "FDT":
+        """
+        Map a .dtb/.dtbo file and parse it in place.
+        """
+        with open(path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                raise FDTError(f"{path}: empty file")
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            fdt = cls.from_bytes(mm)
+        except Exception:
+            mm.close()
+            raise
+        fdt._mmap = mm
+        return fdt
+
+    @classmethod
+    def from_bytes(cls, buf) -> "FDT":
+        """
+        Parse a blob from any buffer, property values are views into it.
+        """
+        view = memoryview(buf).cast("B")
+        if len(view) < HEADER.size:
+            view.release()
+            raise FDTError("blob too small for an FDT header")
+        (
+            magic,
+            totalsize,
+            off_struct,
+            off_strings,
+            off_rsvmap,
+            version,
+            _,
+            boot_cpuid,
+            size_strings,
+            size_struct,
+        ) = HEADER.unpack_from(view)
+        if magic != FDT_MAGIC:
+            view.release()
+            raise FDTError(f"bad magic 0x{magic:08x}")
+        if totalsize > len(view) or version < 16:
+            view.release()
+            raise FDTError("truncated blob or unsupported FDT version")
+
+        fdt = cls(boot_cpuid=boot_cpuid)
+        fdt._view = view
+        try:
+            offset = off_rsvmap
+            while True:
+                address, size = RESERVE.unpack_from(view, offset)
+                offset += RESERVE.size
+                if not address and not size:
+                    break
+                fdt.memreserve.append((address, size))
+
+            end = off_struct + size_struct if version >= 17 else totalsize
+            with view[off_strings : off_strings + size_strings] as strings_block:
+                fdt._parse_struct(view, off_struct, end, strings_block)
+        except (struct.error, IndexError) as e:
+            fdt.close()
+            raise FDTError(f"corrupt blob: {e}") from None
+        return fdt
+
+    def _parse_struct(self, view, offset: int, end: int, strings_block) -> None:
+        node = None
+        while offset < end:
+            (token,) = TOKEN.unpack_from(view, offset)
+            offset += 4
+            if token == FDT_BEGIN_NODE:
+                name_end = offset
+                while view[name_end]:
+                    name_end += 1
+                name = bytes(view[offset:name_end]).decode(errors="replace")
+                offset = _align(name_end + 1)
+                node = self.root if node is None else node.add(name)
+            elif token == FDT_PROP:
+                length, nameoff = PROP.unpack_from(view, offset)
+                offset += PROP.size
+                name_end = nameoff
+                while strings_block[name_end]:
+                    name_end += 1
+                name = bytes(strings_block[nameoff:name_end]).decode()
+                if node is None:
+                    raise FDTError("property outside of a node")
+                node.props[name] = view[offset : offset + length]
+                offset = _align(offset + length)
+            elif token == FDT_END_NODE:
+                if node is None:
+                    raise FDTError("unbalanced END_NODE")
+                if node.parent is None:
+                    node = self.root
+                else:
+                    node = node.parent
+            elif token == FDT_END:
+                return
+            elif token != FDT_NOP:
+                raise FDTError(f"unknown token 0x{token:x} at {offset - 4}")
+
+    @classmethod
+    def from_fs(cls, path: str = "/proc/device-tree") -> "FDT":
+        """
+        Load a tree exposed as a directory, like /proc/device-tree.
+        """
+        fdt = cls()
+        stack = [(path, fdt.root)]
+        while stack:
+            directory, node = stack.pop()
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, node.add(entry.name)))
+                elif entry.is_file(follow_symlinks=False):
+                    with open(entry.path, "rb") as f:
+                        node.props[entry.name] = f.read()
+        return fdt
+
+    def to_fs(self, path: str) -> None:
+        """
+        Write the tree out as a directory, the layout of /proc/device-tree.
+        """
+        for node in self.walk():
+            directory = os.path.join(path, node.path.lstrip("/"))
+            os.makedirs(directory, exist_ok=True)
+            for prop, value in node.props.items():
+                with open(os.path.join(directory, prop), "wb") as f:
+                    f.write(value)
+
+    def to_dtb(self) -> bytes:
+        """
+        Serialize the tree into a version 17 blob.
+        """
+        struct_block = bytearray()
+        strings_block = bytearray()
+        offsets = {}
+
+        def emit(node: Node) -> None:
+            name = node.name.encode() + b"\0"
+            struct_block.extend(TOKEN.pack(FDT_BEGIN_NODE))
+            struct_block.extend(name.ljust(_align(len(name)), b"\0"))
+            for prop, value in node.props.items():
+                nameoff = offsets.get(prop)
+                if nameoff is None:
+                    nameoff = offsets[prop] = len(strings_block)
+                    strings_block.extend(prop.encode() + b"\0")
+                struct_block.extend(TOKEN.pack(FDT_PROP))
+                struct_block.extend(PROP.pack(len(value), nameoff))
+                struct_block.extend(value)
+                struct_block.extend(b"\0" * (_align(len(value)) - len(value)))
+            for child in node.children.values():
+                emit(child)
+            struct_block.extend(TOKEN.pack(FDT_END_NODE))
+
+        emit(self.root)
+        struct_block.extend(TOKEN.pack(FDT_END))
+
+        off_rsvmap = _align(HEADER.size, 8)
+        rsvmap = b"".join(RESERVE.pack(a, s) for a, s in self.memreserve)
+        rsvmap += RESERVE.pack(0, 0)
+        off_struct = off_rsvmap + len(rsvmap)
+        off_strings = off_struct + len(struct_block)
+        totalsize = off_strings + len(strings_block)
+
+        header = HEADER.pack(
+            FDT_MAGIC,
+            totalsize,
+            off_struct,
+            off_strings,
+            off_rsvmap,
+            FDT_VERSION,
+            FDT_LAST_COMP_VERSION,
+            self.boot_cpuid,
+            len(strings_block),
+            len(struct_block),
+        )
+        return b"".join(
+            (
+                header,
+                b"\0" * (off_rsvmap - len(header)),
+                rsvmap,
+                struct_block,
+                strings_block,
+            )
+        )
+
+    def to_dts(self) -> str:
+        """
+        Render the tree as DTS source, laid out like dtc output.
+        """
+        out = ["/dts-v1/;\n\n"]
+        for address, size in self.memreserve:
+            out.append(f"/memreserve/\t0x{address:016x} 0x{size:016x};\n")
+
+        def emit(node: Node, depth: int) -> None:
+            indent = "\t" * depth
+            out.append(f"{indent}{node.name or '/'} {{\n")
+            for prop, value in node.props.items():
+                formatted = format_value(value)
+                if formatted:
+                    out.append(f"{indent}\t{prop} = {formatted};\n")
+                else:
+                    out.append(f"{indent}\t{prop};\n")
+            for child in node.children.values():
+                out.append("\n")
+                emit(child, depth + 1)
+            out.append(f"{indent}}};\n")
+
+        emit(self.root, 0)
+        return "".join(out)
+
+
+class OverlayError(FDTError):
+    pass
+
+
+class OverlayApplier:
+    """
+    Apply a stack of overlays onto one base tree.
+
+    The phandle and __symbols__ indexes are built once from the base and kept
+    up to date as overlays are merged, so each overlay costs time proportional
+    to its own size. Properties that a later overlay overwrites with a
+    different value after an earlier one set them are reported as conflicts,
+    with phandle references compared by the path of the node they point at.
+    """
+
+    SPECIAL = ("__symbols__", "__fixups__", "__local_fixups__")
+
+    def __init__(self, base: FDT) -> None:
+        self.base = base
+        self.phandles = {}
+        # Phandles of the overlay being merged: (node, path it lands at)
+        self.incoming = {}
+        self.owners = {}
+        self.conflicts = []
+        for node in base.walk():
+            self._index(node)
+        self.max_phandle = max(self.phandles, default=0)
+        symbols = base.find("/__symbols__")
+        self.symbols = (
+            {label: strings(value)[0] for label, value in symbols.props.items()}
+            if symbols is not None
+            else {}
+        )
+
+    def _index(self, node: Node) -> None:
+        for prop in ("phandle", "linux,phandle"):
+            value = node.props.get(prop)
+            if value is not None and len(value) == 4:
+                self.phandles[cells(value)[0]] = node
+
+    def _ref(self, phandle: int) -> str:
+        if phandle in self.incoming:
+            return self.incoming[phandle][1]
+        node = self.phandles.get(phandle)
+        return node.path if node is not None else f"0x{phandle:02x}"
+
+    def _provider(self, phandle: int) -> Node | None:
+        if phandle in self.incoming:
+            return self.incoming[phandle][0]
+        return self.phandles.get(phandle)
+
+    def apply(self, overlay: FDT, name: str = "overlay") -> None:
+        """
+        Merge one overlay into the base.
+        Raises OverlayError before anything is merged if the overlay has
+        unresolved references or targets.
+        """
+        root = overlay.root
+        # Renumber the overlay's own phandles past the base ones
+        delta = top = self.max_phandle
+        incoming = []
+        for node in root.walk():
+            for prop in ("phandle", "linux,phandle"):
+                value = node.props.get(prop)
+                if value is not None and len(value) == 4:
+                    phandle = cells(value)[0] + delta
+                    node.props[prop] = struct.pack(">I", phandle)
+                    top = max(top, phandle)
+                    incoming.append((phandle, node))
+
+        local_fixups = root.children.get("__local_fixups__")
+        if local_fixups is not None:
+            for fixup in local_fixups.walk():
+                target = root.find(fixup.path[len("/__local_fixups__") :])
+                if target is None:
+                    raise OverlayError(f"bad __local_fixups__ {fixup.path}")
+                for prop, offsets in fixup.props.items():
+                    value = bytearray(target.props.get(prop, b""))
+                    for offset in cells(offsets):
+                        if offset + 4 > len(value):
+                            raise OverlayError(
+                                f"local fixup past end of {target.path}:{prop}"
+                            )
+                        (old,) = struct.unpack_from(">I", value, offset)
+                        struct.pack_into(">I", value, offset, old + delta)
+                    target.props[prop] = bytes(value)
+
+        # Resolve references to labels of the base. Base nodes without a
+        # phandle get one only once the whole overlay resolved.
+        assigned = {}
+        fixups = root.children.get("__fixups__")
+        if fixups is not None:
+            for label, refs in fixups.props.items():
+                path = self.symbols.get(label)
+                node = self.base.find(path) if path is not None else None
+                if node is None:
+                    raise OverlayError(f"unresolved label '{label}'")
+                value = node.props.get("phandle") or node.props.get("linux,phandle")
+                if value is not None:
+                    phandle = cells(value)[0]
+                elif id(node) in assigned:
+                    phandle = assigned[id(node)][0]
+                else:
+                    top += 1
+                    phandle = top
+                    assigned[id(node)] = (phandle, node)
+                for ref in strings(refs):
+                    ref_path, prop, offset = ref.rsplit(":", 2)
+                    target = root.find(ref_path)
+                    if target is None or prop not in target.props:
+                        raise OverlayError(f"bad fixup '{ref}'")
+                    value = bytearray(target.props[prop])
+                    struct.pack_into(">I", value, int(offset), phandle)
+                    target.props[prop] = bytes(value)
+
+        fragments = []
+        for fragment in root.children.values():
+            if fragment.name in self.SPECIAL or "__overlay__" not in fragment.children:
+                continue
+            if "target" in fragment.props:
+                phandle = cells(fragment.props["target"])[0]
+                target = self.phandles.get(phandle)
+                if target is None:
+                    target = next(
+                        (n for p, n in assigned.values() if p == phandle), None
+                    )
+                where = f"phandle 0x{phandle:x}"
+            elif "target-path" in fragment.props:
+                where = strings(fragment.props["target-path"])[0]
+                if not where.startswith("/"):
+                    where = self.symbols.get(where, where)
+                target = self.base.find(where)
+            else:
+                raise OverlayError(f"{fragment.name} has no target")
+            if target is None:
+                raise OverlayError(f"{fragment.name} target {where} not found")
+            fragments.append((fragment, target))
+
+        # Everything resolved, merge into the base
+        for phandle, node in assigned.values():
+            node.props["phandle"] = struct.pack(">I", phandle)
+            self.phandles[phandle] = node
+        self.max_phandle = top
+
+        # Where the overlay's own phandles end up, for comparing references
+        self.incoming = {}
+        for phandle, node in incoming:
+            for fragment, target in fragments:
+                prefix = f"/{fragment.name}/__overlay__"
+                if node.path == prefix or node.path.startswith(prefix + "/"):
+                    path = target.path.rstrip("/") + node.path[len(prefix) :]
+                    self.incoming[phandle] = (node, path or "/")
+                    break
+
+        for fragment, target in fragments:
+            self._merge(fragment.children["__overlay__"], target, name)
+        self.incoming = {}
+
+        overlay_symbols = root.children.get("__symbols__")
+        if overlay_symbols is not None:
+            targets = {
+                f"/{fragment.name}/__overlay__": target.path
+                for fragment, target in fragments
+            }
+            for label, value in overlay_symbols.props.items():
+                path = strings(value)[0]
+                for prefix, target_path in targets.items():
+                    if path == prefix or path.startswith(prefix + "/"):
+                        rest = path[len(prefix) :]
+                        path = (target_path.rstrip("/") + rest) or "/"
+                        break
+                previous = self.symbols.get(label)
+                if previous is not None and previous != path:
+                    owner = self.owners.get(("/__symbols__", label), "base")
+                    self.conflicts.append(("/__symbols__", label, owner, name))
+                self.owners[("/__symbols__", label)] = name
+                self.symbols[label] = path
+                self.base.root.add("__symbols__").props[label] = path.encode() + b"\0"
+
+    def _merge(self, source: Node, target: Node, name: str) -> None:
+        stack = [(source, target)]
+        while stack:
+            source, target = stack.pop()
+            for prop, value in source.props.items():
+                value = bytes(value)
+                key = (target.path, prop)
+                owner = self.owners.get(key)
+                if (
+                    owner is not None
+                    and owner != name
+                    and prop not in ("phandle", "linux,phandle")
+                    and self._render(target, prop, target.props[prop])
+                    != self._render(source, prop, value)
+                ):
+                    self.conflicts.append((target.path, prop, owner, name))
+                target.props[prop] = value
+                self.owners[key] = name
+            self._index(target)
+            for child in source.children.values():
+                stack.append((child, target.add(child.name)))
+
+    def _render(self, node: Node, prop: str, value) -> str:
+        return _render_refs(node, prop, value, self._provider, self._ref)
+
+
+def apply_overlays(base: FDT, overlays: list) -> list:
+    """
+    Apply (name, FDT) overlays in order, returns the conflicts found.
+    """
+    applier = OverlayApplier(base)
+    for name, overlay in overlays:
+        applier.apply(overlay, name)
+    return applier.conflicts
+
+
+# Properties holding phandle + specifier lists, mapped to the provider
+# property giving the specifier length
+PHANDLE_SPECIFIERS = {
+    "clocks": "#clock-cells",
+    "assigned-clocks": "#clock-cells",
+    "assigned-clock-parents": "#clock-cells",
+    "resets": "#reset-cells",
+    "phys": "#phy-cells",
+    "power-domains": "#power-domain-cells",
+    "dmas": "#dma-cells",
+    "iommus": "#iommu-cells",
+    "interrupts-extended": "#interrupt-cells",
+    "mboxes": "#mbox-cells",
+    "io-channels": "#io-channel-cells",
+    "pwms": "#pwm-cells",
+    "thermal-sensors": "#thermal-sensor-cells",
+    "sound-dai": "#sound-dai-cells",
+    "cooling-device": "#cooling-cells",
+    "hwlocks": "#hwlock-cells",
+    "interconnects": "#interconnect-cells",
+    "gpios": "#gpio-cells",
+}
+
+# Properties holding nothing but phandles
+PHANDLE_LISTS = {
+    "interrupt-parent",
+    "remote-endpoint",
+    "phy-handle",
+    "memory-region",
+    "operating-points-v2",
+    "nvmem-cells",
+    "cpu",
+    "trip",
+    "msi-parent",
+}
+
+
+def _phandle_kind(prop: str) -> str | None:
+    """
+    Return the specifier cells property, "" for plain phandle lists.
+    """
+    if prop in PHANDLE_SPECIFIERS:
+        return PHANDLE_SPECIFIERS[prop]
+    if prop.endswith(("-gpios", "-gpio")):
+        return "#gpio-cells"
+    if prop in PHANDLE_LISTS or prop.endswith("-supply"):
+        return ""
+    if prop.startswith("pinctrl-") and prop[8:].isdigit():
+        return ""
+    return None
+
+
+def _render_refs(node: Node, prop: str, value, provider, ref) -> str:
+    """
+    Render a property with its phandles passed through ref(), provider()
+    gives the node behind a phandle for the length of its specifiers.
+    """
+    kind = _phandle_kind(prop)
+    if kind is None or not len(value) or len(value) % 4 or "gpio-hog" in node.props:
+        return format_value(value)
+    values = cells(value)
+    if not kind:
+        return "<" + " ".join(ref(c) for c in values) + ">"
+    out = []
+    i = 0
+    while i < len(values):
+        target = provider(values[i])
+        if target is None or kind not in target.props:
+            out.extend(f"0x{c:02x}" for c in values[i:])
+            break
+        count = cells(target.props[kind])[0]
+        out.append(ref(values[i]))
+        out.extend(f"0x{c:02x}" for c in values[i + 1 : i + 1 + count])
+        i += 1 + count
+    return "<" + " ".join(out) + ">"
+
+
+def tree_map(fdt: FDT) -> dict:
+    """
+    Index a tree as {path: {property: value}}, with phandle references
+    rendered as the label (or path) of the node they point at, so trees
+    with different phandle numbering compare equal.
+    """
+    phandles = {}
+    for node in fdt.walk():
+        for prop in ("phandle", "linux,phandle"):
+            value = node.props.get(prop)
+            if value is not None and len(value) == 4:
+                phandles[cells(value)[0]] = node
+
+    labels = {}
+    symbols = fdt.find("/__symbols__")
+    if symbols is not None:
+        for label in sorted(symbols.props):
+            labels.setdefault(strings(symbols.props[label])[0], label)
+
+    def ref(phandle: int) -> str:
+        node = phandles.get(phandle)
+        if node is None:
+            return f"0x{phandle:02x}"
+        path = node.path
+        return "&" + labels.get(path, "{" + path + "}")
+
+    result = {}
+    for node in fdt.walk():
+        result[node.path] = {
+            prop: _render_refs(node, prop, value, phandles.get, ref)
+            for prop, value in node.props.items()
+            if prop not in ("phandle", "linux,phandle")
+        }
+    return result
+
+
+def diff_maps(old: dict, new: dict) -> dict:
+    """
+    Compare two tree_map() results.
+    """
+    added = [path for path in new if path not in old]
+    removed = [path for path in old if path not in new]
+    changed = {}
+    for path, props in new.items():
+        before = old.get(path)
+        if before is None or before == props:
+            continue
+        delta = {
+            "added": {p: v for p, v in props.items() if p not in before},
+            "removed": {p: v for p, v in before.items() if p not in props},
+            "changed": {
+                p: [before[p], v]
+                for p, v in props.items()
+                if p in before and before[p] != v
+            },
+        }
+        if any(delta.values()):
+            changed[path] = delta
+    return {"added": added, "removed": removed, "changed": changed}
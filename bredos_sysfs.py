@@ -0,0 +1,146 @@
+"""
+Batched sysfs attribute access.
+
+Every device directory is opened once and its attributes are read relative
+to that directory fd, with results kept for the rest of the run. The root
+can be moved, so tools built on this also work on captured or fake trees.
+
+This module is part of BredOS-Tools, licenced under the GPL-3.0 licence.
+
+Bill Sideris <bill88t@bredos.org>
+"""
+
+import os
+import threading
+
+ROOT = "/sys"
+READ_SIZE = 64 * 1024
+
+_dirs = {}
+_lock = threading.Lock()
+
+
+def set_root(path: str) -> None:
+    """
+    Read everything below path instead of /sys from now on.
+    """
+    global ROOT
+    clear()
+    ROOT = os.path.abspath(path)
+
+
+def path(*parts: str) -> str:
+    """
+    Absolute path of parts below the root.
+    """
+    return os.path.join(ROOT, *parts)
+
+
+def listdir(directory: str) -> list:
+    """
+    Sorted entries of a directory, empty if it can't be listed.
+    """
+    try:
+        return sorted(os.listdir(directory))
+    except OSError:
+        return []
+
+
+class SysfsDir:
+    """
+    A directory opened once, attributes are read relative to its fd and
+    remembered until clear().
+    """
+
+    __slots__ = ("path", "fd", "values")
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+        self.values = {}
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def read(self, name: str) -> str | None:
+        """
+        Stripped contents of an attribute, None when it can't be read.
+        """
+        if name in self.values:
+            return self.values[name]
+        try:
+            fd = os.open(name, os.O_RDONLY | os.O_CLOEXEC, dir_fd=self.fd)
+            try:
+                value = os.read(fd, READ_SIZE).decode(errors="replace").strip()
+            finally:
+                os.close(fd)
+        except OSError:
+            value = None
+        self.values[name] = value
+        return value
+
+    def read_many(self, names) -> dict:
+        return {name: self.read(name) for name in names}
+
+    def link(self, name: str) -> str | None:
+        """
+        Last component of a symlink such as driver or subsystem.
+        """
+        key = "->" + name
+        if key not in self.values:
+            try:
+                self.values[key] = os.path.basename(os.readlink(name, dir_fd=self.fd))
+            except OSError:
+                self.values[key] = None
+        return self.values[key]
+
+
+def open_dir(directory: str) -> SysfsDir | None:
+    """
+    The cached SysfsDir of directory, None if it can't be opened.
+    """
+    entry = _dirs.get(directory)
+    if entry is not None:
+        return entry
+    try:
+        entry = SysfsDir(directory)
+    except OSError:
+        return None
+    with _lock:
+        if directory in _dirs:
+            entry.close()
+            return _dirs[directory]
+        _dirs[directory] = entry
+    return entry
+
+
+def read(directory: str, name: str) -> str | None:
+    entry = open_dir(directory)
+    return entry.read(name) if entry else None
+
+
+def read_many(directory: str, names) -> dict:
+    """
+    Several attributes of one directory, through a single directory fd.
+    """
+    entry = open_dir(directory)
+    if entry is None:
+        return dict.fromkeys(names)
+    return entry.read_many(names)
+
+
+def link(directory: str, name: str) -> str | None:
+    entry = open_dir(directory)
+    return entry.link(name) if entry else None
+
+
+def clear() -> None:
+    """
+    Close every directory and forget what was read, for a fresh run.
+    """
+    with _lock:
+        for entry in _dirs.values():
+            entry.close()
+        _dirs.clear()
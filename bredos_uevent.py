@@ -0,0 +1,132 @@
+"""
+Kernel uevent listener over NETLINK_KOBJECT_UEVENT.
+
+Events can also be replayed from a unix datagram socket or a recorded file,
+so tools built on this can be tested without real hotplug.
+
+This module is part of BredOS-Tools, licenced under the GPL-3.0 licence.
+
+Bill Sideris <bill88t@bredos.org>
+"""
+
+import os
+import errno
+import select
+import socket
+
+NETLINK_KOBJECT_UEVENT = 15
+KERNEL_GROUP = 1
+BUFFER_SIZE = 64 * 1024
+
+
+def parse(data: bytes) -> dict | None:
+    """
+    Parse a uevent, "action@devpath" followed by NUL or newline separated
+    KEY=VALUE pairs. Messages from udev itself are ignored.
+    """
+    if data.startswith(b"libudev\0"):
+        return None
+    event = {}
+    for field in data.replace(b"\n", b"\0").split(b"\0"):
+        key, sep, value = field.decode(errors="replace").partition("=")
+        if sep:
+            event[key] = value
+        elif "@" in key:
+            action, _, devpath = key.partition("@")
+            event.setdefault("ACTION", action)
+            event.setdefault("DEVPATH", devpath)
+    return event if "ACTION" in event else None
+
+
+def read_events(path: str):
+    """
+    Yield events recorded in a file, one block of lines per event with blank
+    lines in between (the layout of `udevadm monitor --kernel --property`).
+    """
+    with open(path, "rb") as f:
+        blocks = f.read().split(b"\n\n")
+    for block in blocks:
+        lines = []
+        for line in block.splitlines():
+            # udevadm prints "KERNEL[123.456] add /devices/... (subsystem)"
+            if line.startswith(b"KERNEL[") or line.startswith(b"UDEV["):
+                parts = line.split()
+                if len(parts) >= 3:
+                    lines.append(parts[1] + b"@" + parts[2])
+            elif line.strip():
+                lines.append(line.strip())
+        event = parse(b"\0".join(lines))
+        if event is not None:
+            yield event
+
+
+class UeventMonitor:
+    """
+    Non-blocking uevent socket, optionally filtered by subsystem.
+
+    With source set to a path, a unix datagram socket is bound there instead
+    and anything sent to it is parsed like a kernel uevent.
+
+    When the socket buffer overflows the kernel drops events. lost is then
+    set by the drain (or poll) that noticed, so callers caching device
+    state know to rebuild it from sysfs.
+    """
+
+    def __init__(self, subsystems: set | None = None, source: str | None = None):
+        self.subsystems = set(subsystems) if subsystems else None
+        if source is None:
+            self.sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT
+            )
+            self.sock.bind((0, KERNEL_GROUP))
+        else:
+            if os.path.exists(source):
+                os.remove(source)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(source)
+        self.sock.setblocking(False)
+        self.lost = False
+
+    def __enter__(self) -> "UeventMonitor":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def drain(self) -> list:
+        """
+        Return every event already queued, without waiting.
+        """
+        events = []
+        self.lost = False
+        while True:
+            try:
+                data = self.sock.recv(BUFFER_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return events
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                self.lost = True
+                continue
+            event = parse(data)
+            if event is None:
+                continue
+            if self.subsystems and event.get("SUBSYSTEM") not in self.subsystems:
+                continue
+            events.append(event)
+
+    def poll(self, timeout: float | None = None) -> list:
+        """
+        Wait up to timeout seconds for events, None waits forever.
+        """
+        if not select.select([self.sock], [], [], timeout)[0]:
+            self.lost = False
+            return []
+        return self.drain()
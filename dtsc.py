@@ -6,68 +6,202 @@ This script is part of BredOS-Tools, licenced under the GPL-3.0 licence.
 Bill Sideris <bill88t@bredos.org>
 """
 
+import io
 import os
+import re
 import sys
+import glob
+import gzip
+import json
+import time
+import ctypes
+import select
+import shutil
+import struct
+import fnmatch
+import hashlib
 import argparse
+import datetime
+import functools
+import resource
 import tempfile
+import textwrap
+import contextlib
 import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from bredos_fdt import (
+    FDT,
+    FDTError,
+    OverlayApplier,
+    cells,
+    diff_maps,
+    format_value,
+    strings,
+    tree_map,
+)
 
-def fdt_hash_from_proc(output_file: str, mode: str = "dts") -> None:
+DTC_FLAGS = ["-I", "dts", "-@", "-O", "dtb"]
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "dtsc"
+)
+CACHE_SIZE = 256  # MiB
+# Where kernel header trees live, and the subdirectory holding them
+KERNEL_ROOTS = {"/usr/src": "", "/usr/lib/modules": "build"}
+SNAPSHOT_DIR = os.path.join(CACHE_DIR, "snapshots")
+SNAPSHOT_VERSION = 1
+SNAPSHOT_INDEX = ".idx"
+
+
+def write_tree(fdt: FDT, output_file: str, mode: str = "dts") -> None:
+    # Render first, the output may be the file backing the tree
+    if mode == "dts":
+        data = fdt.to_dts().encode()
+    else:
+        data = fdt.to_dtb()
+    # Renamed over, so a hardlink into the build cache is never written through
+    temp_file = f"{output_file}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file, "wb") as f:
+            f.write(data)
+        os.replace(temp_file, output_file)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(temp_file)
+        raise
+
+
+def fdt_hash_from_proc(
+    output_file: str, mode: str = "dts", source: str = "/proc/device-tree"
+) -> bool:
     """
     Decompile live-running device tree from /proc/
     """
     try:
-        subprocess.check_output(
-            [
-                "dtc",
-                "-I",
-                "fs",
-                "-O",
-                mode,
-                "-@",
-                "-q",
-                "/proc/device-tree",
-                "-o",
-                output_file,
-            ],
-            stderr=subprocess.DEVNULL,
-        )
-    except subprocess.CalledProcessError:
+        write_tree(FDT.from_fs(source), output_file, mode)
+    except OSError as e:
+        print(f"Error: Could not dump {source}: {e}", file=sys.stderr)
+        return False
+    return True
+
+
+def decomp_dtb(input_file: str, output_file: str) -> bool:
+    try:
+        with FDT.open(input_file) as fdt:
+            write_tree(fdt, output_file)
+    except (OSError, FDTError) as e:
+        print(f"Error: Could not decompile {input_file}: {e}", file=sys.stderr)
+        return False
+    return True
+
+
+def kernel_release(path: str, fallback: str) -> str:
+    """
+    Read the release a header tree was built for, or guess it from its name.
+    """
+    try:
+        with open(os.path.join(path, "include", "config", "kernel.release")) as f:
+            return f.read().strip()
+    except OSError:
+        return re.sub(r"^linux(-headers)?-?", "", fallback) or fallback
+
+
+def kernel_trees() -> list:
+    """
+    Index the installed kernel header trees.
+    The index is cached on disk until /usr/src, /usr/lib/modules or any of
+    the header trees in them change.
+    """
+    stamps = {}
+    for root, subdir in KERNEL_ROOTS.items():
+        try:
+            stamps[root] = os.stat(root).st_mtime_ns
+        except OSError:
+            continue
+        # Headers installed into an existing modules directory only touch it
+        for d in os.listdir(root):
+            path = os.path.join(root, d, subdir)
+            try:
+                stamps[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                stamps[path] = None
+
+    index_file = os.path.join(CACHE_DIR, "kernels.json")
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+        if index["stamps"] == stamps:
+            return index["trees"]
+    except (OSError, ValueError, KeyError):
         pass
 
+    candidates = []
+    for root, subdir in KERNEL_ROOTS.items():
+        if root not in stamps:
+            continue
+        for d in sorted(os.listdir(root)):
+            if subdir or "linux" in d:
+                candidates.append((os.path.normpath(os.path.join(root, d, subdir)), d))
+
+    trees = []
+    seen = set()
+    for path, name in candidates:
+        real = os.path.realpath(path)
+        if real in seen or not os.path.isdir(os.path.join(real, "include")):
+            continue
+        seen.add(real)
+        trees.append({"path": path, "release": kernel_release(real, name)})
 
-def decomp_dtb(input_file: str, output_file: str) -> None:
     try:
-        subprocess.check_output(
-            ["dtc", "-I", "dtb", input_file, "-O", "dts", "-q", "-o", output_file],
-            stderr=subprocess.DEVNULL,
-        )
-    except subprocess.CalledProcessError:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(f"{index_file}.{os.getpid()}.tmp", "w") as f:
+            json.dump({"stamps": stamps, "trees": trees}, f)
+        os.replace(f"{index_file}.{os.getpid()}.tmp", index_file)
+    except OSError:
         pass
+    return trees
 
 
-def preprocess_dts(input_file: str, temp_file: str, include: str, kernel: str) -> bool:
+@functools.cache
+def find_kernel() -> str | None:
+    """
+    Pick the header tree matching the running kernel, else the newest one.
+    """
+    trees = kernel_trees()
+    release = os.uname().release
+    for tree in trees:
+        if tree["release"] == release:
+            return tree["path"]
+
+    def version(tree: dict) -> tuple:
+        return tuple(int(n) for n in re.findall(r"\d+", tree["release"]))
+
+    return max(trees, key=version)["path"] if trees else None
+
+
+def preprocess_dts(
+    input_file: str,
+    temp_file: str,
+    include: str,
+    kernel: str,
+    quiet: bool = False,
+    depfile: str = None,
+) -> bool:
     """
     Preprocess the DTS file using the C preprocessor.
+    When depfile is given, cpp writes the make-style include dependencies there.
     """
     linux_include_path = kernel
     if not linux_include_path:
-        linux_include_path = next(
-            (
-                os.path.join("/usr/src", d)
-                for d in os.listdir("/usr/src")
-                if "linux" in d and os.path.isdir(os.path.join("/usr/src", d))
-            ),
-            None,
-        )
+        linux_include_path = find_kernel()
     if not linux_include_path:
         print(
             "Error: Could not find a valid Linux source include directory.",
             file=sys.stderr,
         )
         return False
-    else:
+    elif not quiet:
         print("Using kernel: " + linux_include_path)
 
     cmd = [
@@ -80,6 +214,9 @@ def preprocess_dts(input_file: str, temp_file: str, include: str, kernel: str) -
     if include is not None:
         cmd += ["-I", include]
 
+    if depfile is not None:
+        cmd += ["-MD", "-MF", depfile, "-MT", input_file]
+
     cmd += [
         "-undef",
         "-x",
@@ -88,32 +225,556 @@ def preprocess_dts(input_file: str, temp_file: str, include: str, kernel: str) -
         temp_file,
     ]
 
-    print("Preprocessing...")
+    if not quiet:
+        print("Preprocessing...")
     try:
-        subprocess.run(cmd, check=True)
-    except subprocess.CalledProcessError:
+        subprocess.run(cmd, check=True, capture_output=quiet, text=True)
+    except subprocess.CalledProcessError as e:
+        if quiet and e.stderr:
+            print(e.stderr.rstrip(), file=sys.stderr)
         print("Error: Preprocessing FAILED!", file=sys.stderr)
         return False
     return True
 
 
-def compile_dts(temp_file: str, output_file: str, include: str = None) -> bool:
+def compile_dts(
+    temp_file: str, output_file: str, include: str = None, quiet: bool = False
+) -> bool:
     """
     Compile the preprocessed DTS file into a DTBO or DTB.
     """
     cmd = ["dtc"]
     if include is not None:
         cmd += ["-i", include]
-    cmd += ["-I", "dts", "-@", "-O", "dtb", temp_file, "-o", output_file]
-    print("Compiling...")
+    cmd += DTC_FLAGS + [temp_file, "-o", output_file]
+    if not quiet:
+        print("Compiling...")
+    # Never write through a hardlink into the build cache
+    if os.path.exists(output_file) and os.stat(output_file).st_nlink > 1:
+        os.remove(output_file)
     try:
-        subprocess.run(cmd, check=True)
-    except subprocess.CalledProcessError:
+        subprocess.run(cmd, check=True, capture_output=quiet, text=True)
+    except subprocess.CalledProcessError as e:
+        if quiet and e.stderr:
+            print(e.stderr.rstrip(), file=sys.stderr)
         print("Error: Compiling FAILED!", file=sys.stderr)
         return False
     return True
 
 
+@functools.cache
+def dtc_version() -> str:
+    try:
+        return subprocess.run(
+            ["dtc", "--version"], capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+def cache_key(temp_file: str, include: str = None) -> str:
+    """
+    Hash the preprocessed source together with the dtc version and flags.
+    """
+    with open(temp_file, "rb") as f:
+        data = f.read()
+
+    digest = hashlib.sha256()
+    digest.update(dtc_version().encode())
+    digest.update("\0".join(DTC_FLAGS + [include or ""]).encode())
+    digest.update(data)
+
+    # dtc-level /include/ directives are not expanded by cpp
+    search = [os.path.dirname(temp_file)] + ([include] if include else [])
+    for name in re.findall(rb'/include/\s+"([^"]+)"', data):
+        digest.update(name)
+        for directory in search:
+            path = os.path.join(directory, name.decode(errors="replace"))
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+                break
+    return digest.hexdigest()
+
+
+def cache_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, "objects", key[:2], key)
+
+
+def cache_fetch(key: str, output_file: str) -> bool:
+    """
+    Place a cached blob at output_file, hardlinking when possible.
+    """
+    obj = cache_path(key)
+    if not os.path.isfile(obj):
+        return False
+    try:
+        if os.path.lexists(output_file):
+            os.remove(output_file)
+        try:
+            os.link(obj, output_file)
+        except OSError:
+            shutil.copyfile(obj, output_file)
+        # mtime doubles as the LRU timestamp
+        os.utime(obj)
+    except OSError:
+        return False
+    return True
+
+
+def cache_store(key: str, output_file: str) -> None:
+    obj = cache_path(key)
+    try:
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        temp_obj = f"{obj}.{os.getpid()}.tmp"
+        shutil.copyfile(output_file, temp_obj)
+        os.replace(temp_obj, obj)
+    except OSError:
+        pass
+
+
+def cache_entries() -> list:
+    """
+    List (mtime, size, path) for every cached blob.
+    """
+    entries = []
+    objects = os.path.join(CACHE_DIR, "objects")
+    if not os.path.isdir(objects):
+        return entries
+    for shard in os.scandir(objects):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    return entries
+
+
+def cache_evict(max_size: int = CACHE_SIZE) -> int:
+    """
+    Drop least recently used blobs until the cache fits in max_size MiB.
+    """
+    entries = sorted(cache_entries())
+    total = sum(size for _, size, _ in entries)
+    limit = max_size * 1024 * 1024
+    evicted = 0
+    for _, size, path in entries:
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        evicted += 1
+    return evicted
+
+
+def cache_counters() -> dict:
+    try:
+        with open(os.path.join(CACHE_DIR, "stats.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"hits": 0, "misses": 0}
+
+
+def cache_record(hits: int, misses: int) -> None:
+    """
+    Add to the persistent hit/miss counters.
+    """
+    if not hits and not misses:
+        return
+    counters = cache_counters()
+    counters["hits"] = counters.get("hits", 0) + hits
+    counters["misses"] = counters.get("misses", 0) + misses
+    stats_file = os.path.join(CACHE_DIR, "stats.json")
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(f"{stats_file}.{os.getpid()}.tmp", "w") as f:
+            json.dump(counters, f)
+        os.replace(f"{stats_file}.{os.getpid()}.tmp", stats_file)
+    except OSError:
+        pass
+
+
+def print_cache_stats(max_size: int = CACHE_SIZE) -> None:
+    entries = cache_entries()
+    counters = cache_counters()
+    total = sum(size for _, size, _ in entries)
+    lookups = counters.get("hits", 0) + counters.get("misses", 0)
+    print(f"Cache directory: {CACHE_DIR}")
+    print(f"Entries:         {len(entries)}")
+    print(f"Size:            {total / 1048576:.1f} MiB / {max_size} MiB")
+    print(f"Hits:            {counters.get('hits', 0)}")
+    print(f"Misses:          {counters.get('misses', 0)}")
+    if lookups:
+        print(f"Hit ratio:       {100 * counters.get('hits', 0) / lookups:.1f}%")
+
+
+def parse_depfile(depfile: str) -> list:
+    """
+    Read the prerequisites out of a make-style dependency file.
+    """
+    with open(depfile) as f:
+        text = f.read().replace("\\\n", " ")
+    _, _, prereqs = text.partition(": ")
+    deps = []
+    for dep in re.split(r"(?<!\\)\s+", prereqs.strip()):
+        if dep:
+            deps.append(os.path.abspath(dep.replace("\\ ", " ")))
+    return deps
+
+
+def deps_path(output_file: str) -> str:
+    key = hashlib.sha1(os.path.abspath(output_file).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, "deps", key + ".json")
+
+
+def deps_record(output_file: str, input_file: str, deps: list) -> None:
+    """
+    Remember which files an output was built from.
+    """
+    path = deps_path(output_file)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.{os.getpid()}.tmp", "w") as f:
+            json.dump(
+                {
+                    "output": os.path.abspath(output_file),
+                    "input": os.path.abspath(input_file),
+                    "deps": deps,
+                },
+                f,
+            )
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+    except OSError:
+        pass
+
+
+def deps_load(output_file: str) -> list | None:
+    try:
+        with open(deps_path(output_file)) as f:
+            return json.load(f)["deps"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def build_dts(
+    input_file: str,
+    output_file: str,
+    include: str,
+    kernel: str,
+    quiet: bool = False,
+    cache: bool = True,
+) -> str | None:
+    """
+    Run the preprocess -> compile pipeline for a single DTS file.
+    Returns "cached" or "compiled", None on failure.
+    """
+    with tempfile.NamedTemporaryFile(delete=False) as temp:
+        temp_file = temp.name
+    depfile = temp_file + ".d"
+
+    try:
+        if not preprocess_dts(input_file, temp_file, include, kernel, quiet, depfile):
+            return None
+        try:
+            deps_record(output_file, input_file, parse_depfile(depfile))
+        except OSError:
+            pass
+        key = cache_key(temp_file, include) if cache else None
+        if key is not None and cache_fetch(key, output_file):
+            if not quiet:
+                print("Cache hit, skipping compile.")
+            return "cached"
+        if not compile_dts(temp_file, output_file, include, quiet):
+            return None
+        if key is not None:
+            cache_store(key, output_file)
+        return "compiled"
+    finally:
+        for path in (temp_file, depfile):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def cpu_time() -> float:
+    """
+    CPU seconds used by this process and its reaped children.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def collect_inputs(patterns: list) -> list:
+    """
+    Expand files, directories and globs into a list of DTS sources.
+    """
+    found = {}
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = glob.glob(os.path.join(pattern, "**", "*.dts"), recursive=True)
+        elif glob.has_magic(pattern):
+            matches = glob.glob(pattern, recursive=True)
+        else:
+            matches = [pattern]
+        for match in sorted(matches):
+            found[match] = None
+    return list(found)
+
+
+def batch_output(input_file: str, outdir: str | None) -> str:
+    """
+    Pick the output name for a batch input, .dtbo for /plugin/ sources.
+    """
+    with open(input_file, errors="replace") as f:
+        overlay = "/plugin/" in f.read()
+    output_file = input_file.rsplit(".", 1)[0] + (".dtbo" if overlay else ".dtb")
+    if outdir is not None:
+        output_file = os.path.join(outdir, os.path.basename(output_file))
+    return output_file
+
+
+def batch_job(job: tuple) -> tuple:
+    """
+    Worker entry point, builds one file and captures its diagnostics.
+    """
+    input_file, output_file, include, kernel, cache = job
+    start = time.perf_counter()
+    cpu_start = cpu_time()
+    with contextlib.redirect_stderr(io.StringIO()) as err:
+        status = build_dts(input_file, output_file, include, kernel, True, cache)
+    return (
+        input_file,
+        output_file,
+        status,
+        err.getvalue().strip(),
+        time.perf_counter() - start,
+        cpu_time() - cpu_start,
+    )
+
+
+def batch_compile(
+    inputs: list,
+    outdir: str | None,
+    include: str,
+    kernel: str,
+    jobs: int | None,
+    cache: bool = True,
+    cache_size: int = CACHE_SIZE,
+    output_file: str | None = None,
+) -> int:
+    """
+    Compile many DTS files on a process pool, returns the exit code.
+    output_file names the output explicitly when there is a single input.
+    """
+    if not kernel:
+        kernel = find_kernel()
+    if not kernel:
+        print(
+            "Error: Could not find a valid Linux source include directory.",
+            file=sys.stderr,
+        )
+        return 1
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+
+    jobs_list = []
+    failures = []
+    owners = {}
+    for input_file in inputs:
+        if not input_file.endswith(".dts") or not os.path.isfile(input_file):
+            print(f"[FAIL] {input_file}: not a .dts file", file=sys.stderr)
+            failures.append(input_file)
+            continue
+        target = output_file or batch_output(input_file, outdir)
+        owners.setdefault(os.path.abspath(target), []).append(input_file)
+        jobs_list.append((input_file, target, include, kernel, cache))
+
+    # A flat output directory cannot hold two inputs with the same name
+    clashes = [names for names in owners.values() if len(names) > 1]
+    if clashes:
+        for names in clashes:
+            print(
+                f"Error: {', '.join(names)} would all be written to "
+                f"{batch_output(names[0], outdir)}",
+                file=sys.stderr,
+            )
+        return 1
+
+    workers = max(1, min(jobs or os.cpu_count() or 1, len(jobs_list) or 1))
+    print(f"Using kernel: {kernel}")
+    print(f"Building {len(jobs_list)} file(s) with {workers} job(s)...")
+
+    wall_start = time.perf_counter()
+    cpu_start = cpu_time()
+    hits = 0
+    misses = 0
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("fork")
+    ) as pool:
+        futures = [pool.submit(batch_job, job) for job in jobs_list]
+        for future in as_completed(futures):
+            input_file, output_file, status, error, wall, cpu = future.result()
+            timing = f"({wall:.2f}s wall, {cpu:.2f}s cpu)"
+            if status == "cached":
+                hits += 1
+                print(f"[HIT ] {input_file} -> {output_file} {timing}")
+            elif status:
+                misses += 1
+                print(f"[ OK ] {input_file} -> {output_file} {timing}")
+            else:
+                print(f"[FAIL] {input_file} {timing}")
+                if error:
+                    print(textwrap.indent(error, "    "), file=sys.stderr)
+                failures.append(input_file)
+    wall = time.perf_counter() - wall_start
+    cpu = cpu_time() - cpu_start
+
+    if cache:
+        cache_record(hits, misses)
+        cache_evict(cache_size)
+
+    total = len(inputs)
+    print(
+        f"\n{total - len(failures)}/{total} built ({hits} cached) in {wall:.2f}s wall, {cpu:.2f}s cpu"
+    )
+    if failures:
+        print(f"{len(failures)} failed:", file=sys.stderr)
+        for input_file in failures:
+            print(f"  {input_file}", file=sys.stderr)
+        return 1
+    return 0
+
+
+class Inotify:
+    """
+    Minimal inotify binding, watches directories for file changes.
+    """
+
+    MASK = 0x4 | 0x8 | 0x80 | 0x100  # ATTRIB | CLOSE_WRITE | MOVED_TO | CREATE
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self) -> None:
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def add(self, directory: str) -> None:
+        if directory in self.watches.values():
+            return
+        wd = self.libc.inotify_add_watch(self.fd, directory.encode(), self.MASK)
+        if wd >= 0:
+            self.watches[wd] = directory
+
+    def read(self, timeout: float | None = None) -> set:
+        """
+        Wait for events and return the set of changed paths.
+        """
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0").decode()
+            offset += length
+            if wd in self.watches and name:
+                changed.add(os.path.join(self.watches[wd], name))
+        return changed
+
+
+def watch(
+    patterns: list,
+    outdir: str | None,
+    include: str,
+    kernel: str,
+    jobs: int | None,
+    cache: bool = True,
+    cache_size: int = CACHE_SIZE,
+) -> None:
+    """
+    Rebuild outputs whenever one of their transitive includes changes.
+    """
+    # Like a plain build, -o names the output file for a single input
+    # unless it is, or is spelled as, a directory
+    output_file = None
+    if (
+        outdir is not None
+        and len(patterns) == 1
+        and not os.path.isdir(patterns[0])
+        and not glob.has_magic(patterns[0])
+        and not os.path.isdir(outdir)
+        and not outdir.endswith(os.sep)
+    ):
+        if outdir.endswith(".dts"):
+            print("Input and output file extensions must differ.")
+            exit(1)
+        output_file, outdir = outdir, None
+
+    inotify = Inotify()
+    dependents = {}
+
+    def track(inputs: list) -> None:
+        for input_file in inputs:
+            if not input_file.endswith(".dts") or not os.path.isfile(input_file):
+                continue
+            deps = deps_load(output_file or batch_output(input_file, outdir)) or []
+            for dep in set(deps + [os.path.abspath(input_file)]):
+                dependents.setdefault(dep, set()).add(input_file)
+                inotify.add(os.path.dirname(dep))
+
+    inputs = collect_inputs(patterns)
+    batch_compile(inputs, outdir, include, kernel, jobs, cache, cache_size, output_file)
+    track(inputs)
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            inotify.add(os.path.abspath(pattern))
+    print(f"\nWatching {len(dependents)} file(s), Ctrl+C to exit.")
+
+    try:
+        while True:
+            changed = inotify.read()
+            # Coalesce the burst of events editors produce on save
+            while True:
+                more = inotify.read(0.05)
+                if not more:
+                    break
+                changed |= more
+
+            affected = set()
+            for path in changed:
+                affected |= dependents.get(path, set())
+            new = set(collect_inputs(patterns)) - set(inputs)
+            if new:
+                inputs += sorted(new)
+                affected |= new
+            if not affected:
+                continue
+
+            names = ", ".join(sorted(os.path.basename(path) for path in changed))
+            print(f"\nChanged: {names}")
+            rebuild = sorted(affected)
+            batch_compile(
+                rebuild, outdir, include, kernel, jobs, cache, cache_size, output_file
+            )
+            for deps in dependents.values():
+                deps -= affected
+            track(rebuild)
+    except KeyboardInterrupt:
+        print("\r\033[K\nWatch finished")
+
+
 def check_dependencies() -> None:
     """
     Verify required tools are available on the system.
@@ -134,12 +795,453 @@ def check_dependencies() -> None:
         sys.exit(1)
 
 
+def apply_main(argv: list) -> int:
+    parser = argparse.ArgumentParser(
+        prog="dtsc apply",
+        description="Apply a stack of overlays onto a base Device Tree Blob.",
+        epilog="Example: dtsc apply board.dtb a.dtbo b.dtbo -o merged.dtb",
+    )
+    parser.add_argument("base", help="Base .dtb file")
+    parser.add_argument(
+        "overlays", nargs="+", help="Overlay .dtbo files, applied in order"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Write the merged tree to a .dtb or .dts file (optional)",
+        default=None,
+    )
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="Fail when overlays conflict with each other",
+    )
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    try:
+        base = FDT.open(args.base)
+    except (OSError, FDTError) as e:
+        print(f"Error: Could not load {args.base}: {e}", file=sys.stderr)
+        return 1
+
+    with base:
+        applier = OverlayApplier(base)
+        failures = []
+        for path in args.overlays:
+            try:
+                with FDT.open(path) as overlay:
+                    applier.apply(overlay, path)
+            except (OSError, FDTError) as e:
+                print(f"[FAIL] {path}: {e}")
+                failures.append(path)
+                continue
+            print(f"[ OK ] {path}")
+
+        for path, prop, first, second in applier.conflicts:
+            print(
+                f"Conflict: {path}:{prop} set by {first}, overridden by {second}",
+                file=sys.stderr,
+            )
+
+        if args.output and not failures:
+            write_tree(
+                base, args.output, "dts" if args.output.endswith(".dts") else "dtb"
+            )
+            print(f"Merged tree written to {args.output}")
+
+    elapsed = (time.perf_counter() - start) * 1000
+    applied = len(args.overlays) - len(failures)
+    print(
+        f"\n{applied}/{len(args.overlays)} applied, {len(applier.conflicts)} conflict(s) in {elapsed:.1f}ms"
+    )
+    if failures or (args.strict and applier.conflicts):
+        return 1
+    return 0
+
+
+def load_tree(
+    source: str, include: str = None, kernel: str = None, cache: bool = True
+) -> FDT:
+    """
+    Load "system", a .dtb/.dtbo blob, a snapshot or a .dts source (compiled
+    first) as a tree.
+    """
+    if source.lower() == "system":
+        return FDT.from_fs()
+    if source.endswith(".dtsnap"):
+        return snapshot_tree(load_snapshot(source))
+    if not source.endswith(".dts"):
+        return FDT.open(source)
+
+    check_dependencies()
+    with tempfile.NamedTemporaryFile(suffix=".dtb", delete=False) as temp:
+        output_file = temp.name
+    try:
+        if not build_dts(source, output_file, include, kernel, True, cache):
+            raise FDTError(f"failed to compile {source}")
+        # The mapping outlives the unlinked file
+        return FDT.open(output_file)
+    finally:
+        os.remove(output_file)
+
+
+def print_diff(result: dict) -> None:
+    for path in result["removed"]:
+        print(f"- {path}")
+    for path in result["added"]:
+        print(f"+ {path}")
+    for path, delta in result["changed"].items():
+        print(f"~ {path}")
+        for prop, value in delta["removed"].items():
+            print(f"    - {prop}" + (f" = {value}" if value else ""))
+        for prop, value in delta["added"].items():
+            print(f"    + {prop}" + (f" = {value}" if value else ""))
+        for prop, (old, new) in delta["changed"].items():
+            print(f"    ~ {prop}: {old or '(empty)'} -> {new or '(empty)'}")
+
+
+def diff_main(argv: list) -> int:
+    parser = argparse.ArgumentParser(
+        prog="dtsc diff",
+        description="Structurally compare two device trees, ignoring phandle numbering.",
+        epilog="Example: dtsc diff system board.dtb",
+    )
+    parser.add_argument("old", help='"system", .dtb, .dtbo, .dtsnap or .dts')
+    parser.add_argument("new", help='"system", .dtb, .dtbo, .dtsnap or .dts')
+    parser.add_argument(
+        "-i",
+        "--include",
+        help="Source of additional device tree files for .dts inputs (optional)",
+        default=None,
+    )
+    parser.add_argument(
+        "-k",
+        "--kernel",
+        help="Kernel source path for .dts inputs (default: autodetect)",
+        default=None,
+    )
+    parser.add_argument("--json", action="store_true", help="Output JSON")
+    args = parser.parse_args(argv)
+
+    try:
+        old = load_tree(args.old, args.include, args.kernel)
+        new = load_tree(args.new, args.include, args.kernel)
+    except (OSError, FDTError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    with old, new:
+        result = diff_maps(tree_map(old), tree_map(new))
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_diff(result)
+    return 1 if any(result.values()) else 0
+
+
+def boot_id() -> str:
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        return "unknown"
+
+
+def take_snapshot(output_file: str, source: str = "/proc/device-tree") -> dict:
+    """
+    Walk a live device tree once and store it with path, compatible,
+    phandle and label indexes.
+    """
+    fdt = FDT.from_fs(source)
+    nodes = {}
+    compatible = {}
+    phandles = {}
+    for node in fdt.walk():
+        path = node.path
+        nodes[path] = {prop: bytes(value).hex() for prop, value in node.props.items()}
+        if "compatible" in node.props:
+            for compat in strings(node.props["compatible"]):
+                compatible.setdefault(compat, []).append(path)
+        for prop in ("phandle", "linux,phandle"):
+            if len(node.props.get(prop, b"")) == 4:
+                phandles[str(cells(node.props[prop])[0])] = path
+
+    symbols = fdt.find("/__symbols__")
+    labels = (
+        {label: strings(value)[0] for label, value in symbols.props.items()}
+        if symbols is not None
+        else {}
+    )
+
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "boot_id": boot_id(),
+        "kernel": os.uname().release,
+        "source": source,
+        "nodes": nodes,
+        "compatible": compatible,
+        "phandle": phandles,
+        "label": labels,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    with gzip.open(f"{output_file}.{os.getpid()}.tmp", "wt") as f:
+        json.dump(snapshot, f, separators=(",", ":"))
+    os.replace(f"{output_file}.{os.getpid()}.tmp", output_file)
+    write_index(snapshot, output_file)
+    return snapshot
+
+
+def write_index(snapshot: dict, path: str) -> None:
+    """
+    Store the indexes of a snapshot uncompressed next to it, followed by one
+    line per node, so queries read the indexes and only the nodes they print.
+    """
+    body = io.BytesIO()
+    offsets = {}
+    for node_path, props in snapshot["nodes"].items():
+        line = json.dumps(props, separators=(",", ":")).encode() + b"\n"
+        offsets[node_path] = [body.tell(), len(line)]
+        body.write(line)
+    st = os.stat(path)
+    header = {
+        "version": SNAPSHOT_VERSION,
+        "stamp": [st.st_size, st.st_mtime_ns],
+        "path": offsets,
+        "compatible": snapshot["compatible"],
+        "phandle": snapshot["phandle"],
+        "label": snapshot["label"],
+    }
+    tmp = f"{path}{SNAPSHOT_INDEX}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(json.dumps(header, separators=(",", ":")).encode() + b"\n")
+        f.write(body.getbuffer())
+    os.replace(tmp, path + SNAPSHOT_INDEX)
+
+
+def load_index(path: str) -> dict:
+    """
+    Load the indexes stored next to a snapshot, refusing a stale index.
+    """
+    try:
+        st = os.stat(path)
+        with open(path + SNAPSHOT_INDEX, "rb") as f:
+            index = json.loads(f.readline())
+            index["base"] = f.tell()
+    except (OSError, ValueError) as e:
+        raise FDTError(f"{path}: no usable index ({e})") from None
+    if index.get("version") != SNAPSHOT_VERSION or index.get("stamp") != [
+        st.st_size,
+        st.st_mtime_ns,
+    ]:
+        raise FDTError(f"{path}: index is out of date")
+    return index
+
+
+def index_nodes(path: str, index: dict, node_paths: list) -> dict:
+    """
+    Read the properties of the given nodes from a snapshot index.
+    """
+    nodes = {}
+    with open(path + SNAPSHOT_INDEX, "rb") as f:
+        for node_path in node_paths:
+            offset, length = index["path"][node_path]
+            f.seek(index["base"] + offset)
+            nodes[node_path] = json.loads(f.read(length))
+    return nodes
+
+
+def load_snapshot(path: str) -> dict:
+    try:
+        with gzip.open(path, "rt") as f:
+            snapshot = json.load(f)
+    except (gzip.BadGzipFile, ValueError, EOFError) as e:
+        raise FDTError(f"{path}: not a snapshot ({e})") from None
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        raise FDTError(f"{path}: unsupported snapshot version")
+    return snapshot
+
+
+def snapshot_tree(snapshot: dict) -> FDT:
+    """
+    Rebuild a tree from a snapshot, nodes are stored parents first.
+    """
+    fdt = FDT()
+    for path, props in snapshot["nodes"].items():
+        node = fdt.root
+        if path != "/":
+            parent, _, name = path.rpartition("/")
+            node = fdt.find(parent or "/").add(name)
+        for prop, value in props.items():
+            node.props[prop] = bytes.fromhex(value)
+    return fdt
+
+
+def snapshot_main(argv: list) -> int:
+    parser = argparse.ArgumentParser(
+        prog="dtsc snapshot",
+        description="Store an indexed snapshot of the live device tree.",
+        epilog="Example: dtsc snapshot -o before-update.dtsnap",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help=f"Snapshot file (default: {SNAPSHOT_DIR}/BOOT_ID.dtsnap)",
+        default=None,
+    )
+    parser.add_argument(
+        "--source",
+        help="Device tree directory to walk (default: /proc/device-tree)",
+        default="/proc/device-tree",
+    )
+    parser.add_argument(
+        "-l",
+        "--list",
+        action="store_true",
+        help="List the stored per-boot snapshots",
+    )
+    args = parser.parse_args(argv)
+
+    if args.list:
+        if os.path.isdir(SNAPSHOT_DIR):
+            for name in sorted(os.listdir(SNAPSHOT_DIR)):
+                if not name.endswith(".dtsnap"):
+                    continue
+                path = os.path.join(SNAPSHOT_DIR, name)
+                try:
+                    snapshot = load_snapshot(path)
+                except (OSError, FDTError):
+                    continue
+                print(f"{snapshot['created']}  {snapshot['kernel']}  {path}")
+        return 0
+
+    output_file = args.output or os.path.join(SNAPSHOT_DIR, f"{boot_id()}.dtsnap")
+    try:
+        snapshot = take_snapshot(output_file, args.source)
+    except OSError as e:
+        print(f"Error: Could not snapshot {args.source}: {e}", file=sys.stderr)
+        return 1
+    print(f"Snapshot of {len(snapshot['nodes'])} nodes written to {output_file}")
+    return 0
+
+
+def query_main(argv: list) -> int:
+    parser = argparse.ArgumentParser(
+        prog="dtsc query",
+        description="Look up nodes in a device tree snapshot.",
+        epilog="Example: dtsc query compatible 'rockchip,*'",
+    )
+    parser.add_argument(
+        "key",
+        choices=["path", "compatible", "phandle", "label"],
+        help="What to look up by",
+    )
+    parser.add_argument(
+        "value", help="Path, compatible (globs allowed), phandle or label"
+    )
+    parser.add_argument(
+        "-s",
+        "--snapshot",
+        help="Snapshot file (default: this boot's, taken on first use)",
+        default=None,
+    )
+    parser.add_argument("--json", action="store_true", help="Output JSON")
+    args = parser.parse_args(argv)
+
+    path = args.snapshot or os.path.join(SNAPSHOT_DIR, f"{boot_id()}.dtsnap")
+    snapshot = None
+    try:
+        if args.snapshot is None and not os.path.exists(path):
+            take_snapshot(path)
+        try:
+            index = load_index(path)
+        except FDTError:
+            # Snapshots copied without their index are indexed on first query
+            snapshot = load_snapshot(path)
+            with contextlib.suppress(OSError):
+                write_index(snapshot, path)
+            index = {**snapshot, "path": snapshot["nodes"]}
+    except (OSError, FDTError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    if args.key == "path":
+        matches = [args.value] if args.value in index["path"] else []
+    elif args.key == "compatible":
+        compatible = index["compatible"]
+        if glob.has_magic(args.value):
+            keys = fnmatch.filter(compatible, args.value)
+        else:
+            keys = [args.value]
+        matches = [p for key in keys for p in compatible.get(key, [])]
+    elif args.key == "phandle":
+        try:
+            phandle = str(int(args.value, 0))
+        except ValueError:
+            print(f"Error: Invalid phandle '{args.value}'", file=sys.stderr)
+            return 2
+        matches = [index["phandle"][phandle]] if phandle in index["phandle"] else []
+    else:
+        matches = [index["label"][args.value]] if args.value in index["label"] else []
+
+    matches = [p for p in dict.fromkeys(matches) if p in index["path"]]
+    if snapshot is not None:
+        nodes = {p: snapshot["nodes"][p] for p in matches}
+    else:
+        try:
+            nodes = index_nodes(path, index, matches)
+        except (OSError, ValueError) as e:
+            print(f"Error: {path}{SNAPSHOT_INDEX}: {e}", file=sys.stderr)
+            return 2
+    if args.json:
+        print(
+            json.dumps(
+                {
+                    p: {
+                        prop: format_value(bytes.fromhex(value))
+                        for prop, value in nodes[p].items()
+                    }
+                    for p in matches
+                },
+                indent=2,
+            )
+        )
+    else:
+        for p in matches:
+            print(p)
+            for prop, value in nodes[p].items():
+                formatted = format_value(bytes.fromhex(value))
+                print(f"    {prop}" + (f" = {formatted}" if formatted else ""))
+    return 0 if matches else 1
+
+
+SUBCOMMANDS = {
+    "apply": apply_main,
+    "diff": diff_main,
+    "snapshot": snapshot_main,
+    "query": query_main,
+}
+
+
 def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        exit(SUBCOMMANDS[sys.argv[1]](sys.argv[2:]))
+
     parser = argparse.ArgumentParser(
         description="(De)Compile a Device Tree Source / Blob file.",
-        epilog="Example: dtsc my_device_tree.dts -o output.dtbo",
+        epilog="Example: dtsc my_device_tree.dts -o output.dtbo\n"
+        + "Subcommands: "
+        + ", ".join(SUBCOMMANDS)
+        + " (see dtsc SUBCOMMAND --help)",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "input",
+        nargs="*",
+        help="Input file, or several files, directories or globs for batch mode",
     )
-    parser.add_argument("input", nargs="?", help="Input file")
     parser.add_argument(
         "-o",
         "--output",
@@ -156,21 +1258,92 @@ def main() -> None:
     parser.add_argument(
         "-k",
         "--kernel",
-        help="Manualy specify a kernel source path (default: autodetect)",
+        help="Manualy specify a kernel source path (default: autodetect, preferring the running kernel)",
+        default=None,
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Parallel jobs for batch compilation (default: CPU count)",
         default=None,
     )
 
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"Always compile, bypassing the build cache in {CACHE_DIR}",
+    )
+
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        help=f"Build cache size limit in MiB (default: {CACHE_SIZE})",
+        default=CACHE_SIZE,
+    )
+
+    parser.add_argument(
+        "--cache-stats",
+        action="store_true",
+        help="Show build cache statistics and exit",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        help="Keep running and rebuild outputs whose includes change",
+    )
+
     args = parser.parse_args()
 
+    if args.cache_stats:
+        print_cache_stats(args.cache_size)
+        exit(0)
+
     # Print help and exit if no arguments are provided
     if not args.input:
         parser.print_help()
         exit(1)
 
-    # Verify required tools
-    check_dependencies()
+    if args.watch:
+        check_dependencies()
+        watch(
+            args.input,
+            args.output,
+            args.include,
+            args.kernel,
+            args.jobs,
+            not args.no_cache,
+            args.cache_size,
+        )
+        exit(0)
 
-    input_file = args.input
+    if (
+        len(args.input) > 1
+        or args.jobs is not None
+        or os.path.isdir(args.input[0])
+        or glob.has_magic(args.input[0])
+    ):
+        check_dependencies()
+        inputs = collect_inputs(args.input)
+        if not inputs:
+            print("Error: No input files matched.", file=sys.stderr)
+            exit(1)
+        exit(
+            batch_compile(
+                inputs,
+                args.output,
+                args.include,
+                args.kernel,
+                args.jobs,
+                not args.no_cache,
+                args.cache_size,
+            )
+        )
+
+    input_file = args.input[0]
     if input_file.lower() != "system":
         if not input_file.endswith((".dts", ".dtb", ".dtbo")):
             print("Input file must be .dts, .dtb, or .dtbo")
@@ -195,28 +1368,28 @@ def main() -> None:
 
     if not output_file.endswith(".dts"):
         if input_file.lower() == "system":
-            fdt_hash_from_proc(output_file, "dtb")
+            if not fdt_hash_from_proc(output_file, "dtb"):
+                exit(1)
         else:
-            with tempfile.NamedTemporaryFile(delete=False) as temp:
-                temp_file = temp.name
-
-            try:
-                if not preprocess_dts(input_file, temp_file, include, kernel):
-                    exit(1)
-                if not compile_dts(temp_file, output_file, include):
-                    exit(1)
-            finally:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
+            check_dependencies()
+            status = build_dts(
+                input_file, output_file, include, kernel, cache=not args.no_cache
+            )
+            if not status:
+                exit(1)
+            if not args.no_cache:
+                cache_record(status == "cached", status == "compiled")
+                cache_evict(args.cache_size)
 
             print(
                 f"Device Tree Blob {'Overlay ' if output_file.endswith('.dtbo') else ''}successfully created: {output_file}"
             )
     else:
         if input_file.lower() == "system":
-            fdt_hash_from_proc(output_file)
-        else:
-            decomp_dtb(input_file, output_file)
+            if not fdt_hash_from_proc(output_file):
+                exit(1)
+        elif not decomp_dtb(input_file, output_file):
+            exit(1)
 
 
 if __name__ == "__main__":
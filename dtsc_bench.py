@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark harness for dtsc, runs each phase against synthetic device trees.
+
+This script is part of BredOS-Tools, licenced under the GPL-3.0 licence.
+
+Bill Sideris <bill88t@bredos.org>
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import argparse
+import platform
+import tempfile
+import statistics
+
+import dtsc
+from bredos_fdt import FDT, OverlayApplier
+
+BUS_SIZE = 64
+
+
+def synthetic_tree(nodes: int, props: int) -> FDT:
+    """
+    Build a SoC-like tree, devices are spread over buses of BUS_SIZE.
+    """
+    fdt = FDT()
+    root = fdt.root
+    root.props["compatible"] = b"bench,board\0"
+    root.props["#address-cells"] = struct.pack(">I", 1)
+    root.props["#size-cells"] = struct.pack(">I", 1)
+    soc = root.add("soc")
+    soc.props["compatible"] = b"simple-bus\0"
+    for i in range(nodes):
+        bus = soc.add(f"bus@{i // BUS_SIZE:x}")
+        dev = bus.add(f"dev@{i:x}")
+        dev.props["compatible"] = b"bench,dev\0"
+        dev.props["reg"] = struct.pack(">II", i * 0x1000, 0x1000)
+        dev.props["phandle"] = struct.pack(">I", i + 1)
+        for j in range(max(0, props - 3)):
+            dev.props[f"bench,prop-{j}"] = struct.pack(">II", j, i)
+    return fdt
+
+
+def write_sources(
+    fdt: FDT, directory: str, depth: int, overlays: int
+) -> tuple[str, list]:
+    """
+    Split the tree over a chain of depth .dtsi includes plus the main .dts,
+    and write overlays targeting the first bus.
+    """
+    buses = list(fdt.find("/soc").children.values())
+    chunks = [buses[i :: depth + 1] for i in range(depth + 1)]
+
+    def render(part: list) -> str:
+        tree = FDT()
+        soc = tree.root.add("soc")
+        for bus in part:
+            soc.children[bus.name] = bus
+        # Drop the /dts-v1/ header, it may only appear once
+        return tree.to_dts().split("\n", 2)[2]
+
+    for level in range(depth, 0, -1):
+        with open(os.path.join(directory, f"level{level}.dtsi"), "w") as f:
+            if level < depth:
+                f.write(f'#include "level{level + 1}.dtsi"\n')
+            f.write("#include <dt-bindings/bench.h>\n")
+            f.write(render(chunks[level]))
+
+    main = os.path.join(directory, "board.dts")
+    with open(main, "w") as f:
+        f.write("/dts-v1/;\n\n")
+        if depth:
+            f.write('#include "level1.dtsi"\n')
+        f.write("/ {\n\tcompatible = BENCH_COMPATIBLE;\n};\n\n")
+        f.write(render(chunks[0]))
+
+    sources = []
+    for n in range(overlays):
+        path = os.path.join(directory, f"overlay{n}.dts")
+        with open(path, "w") as f:
+            f.write(
+                "/dts-v1/;\n/plugin/;\n\n/ {\n\tfragment@0 {\n"
+                '\t\ttarget-path = "/soc/bus@0";\n\t\t__overlay__ {\n'
+                f'\t\t\toverlay{n} {{\n\t\t\t\tstatus = "okay";\n'
+                f"\t\t\t\tbench,value = <{n}>;\n\t\t\t}};\n"
+                "\t\t};\n\t};\n};\n"
+            )
+        sources.append(path)
+    return main, sources
+
+
+def fake_kernel(directory: str) -> str:
+    bindings = os.path.join(directory, "include", "dt-bindings")
+    os.makedirs(bindings, exist_ok=True)
+    with open(os.path.join(bindings, "bench.h"), "w") as f:
+        f.write('#define BENCH_COMPATIBLE "bench,board"\n')
+    return directory
+
+
+def measure(func, repeat: int) -> dict:
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if func() is False:
+            raise RuntimeError("phase failed")
+        runs.append(time.perf_counter() - start)
+    return {"min": min(runs), "median": statistics.median(runs), "runs": runs}
+
+
+def run(args: argparse.Namespace) -> dict:
+    results = {
+        "params": {
+            "nodes": args.nodes,
+            "props": args.props,
+            "depth": args.depth,
+            "overlays": args.overlays,
+            "repeat": args.repeat,
+        },
+        "env": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "dtc": dtsc.dtc_version() if shutil.which("dtc") else None,
+        },
+        "phases": {},
+    }
+    phases = results["phases"]
+
+    with tempfile.TemporaryDirectory(prefix="dtsc-bench-") as work:
+        fdt = synthetic_tree(args.nodes, args.props)
+        kernel = fake_kernel(os.path.join(work, "kernel"))
+        main, overlays = write_sources(fdt, work, args.depth, args.overlays)
+        temp = os.path.join(work, "board.pp")
+        blob = os.path.join(work, "board.dtb")
+        with open(blob, "wb") as f:
+            f.write(fdt.to_dtb())
+        fake_proc = os.path.join(work, "device-tree")
+        fdt.to_fs(fake_proc)
+
+        phases["preprocess_dts"] = measure(
+            lambda: dtsc.preprocess_dts(main, temp, None, kernel, quiet=True),
+            args.repeat,
+        )
+        if shutil.which("dtc"):
+            phases["compile_dts"] = measure(
+                lambda: dtsc.compile_dts(temp, blob, quiet=True), args.repeat
+            )
+            blobs = []
+            for source in overlays:
+                out = source[:-4] + ".dtbo"
+                pp = source[:-4] + ".pp"
+                if not (
+                    dtsc.preprocess_dts(source, pp, None, kernel, quiet=True)
+                    and dtsc.compile_dts(pp, out, quiet=True)
+                ):
+                    raise RuntimeError(f"could not compile {source}")
+                blobs.append(out)
+
+            def apply() -> None:
+                with FDT.open(blob) as base:
+                    applier = OverlayApplier(base)
+                    for out in blobs:
+                        with FDT.open(out) as overlay:
+                            applier.apply(overlay, out)
+
+            if blobs:
+                phases["apply"] = measure(apply, args.repeat)
+        else:
+            print("dtc not found, skipping compile_dts and apply", file=sys.stderr)
+
+        phases["decomp_dtb"] = measure(
+            lambda: dtsc.decomp_dtb(blob, os.path.join(work, "out.dts")), args.repeat
+        )
+        phases["system"] = measure(
+            lambda: dtsc.fdt_hash_from_proc(
+                os.path.join(work, "system.dts"), source=fake_proc
+            ),
+            args.repeat,
+        )
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Flag phases whose median got slower than the baseline by more than threshold.
+    """
+    regressions = []
+    for phase, current in results["phases"].items():
+        before = baseline.get("phases", {}).get(phase)
+        if before is None or not before["median"]:
+            continue
+        ratio = current["median"] / before["median"]
+        current["baseline_median"] = before["median"]
+        current["ratio"] = ratio
+        if ratio > 1 + threshold:
+            regressions.append(phase)
+    if baseline.get("params") != results["params"]:
+        print("Warning: baseline was taken with different parameters", file=sys.stderr)
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark dtsc phases on synthetic device trees.",
+        epilog="Example: dtsc_bench.py --nodes 5000 -o run.json --baseline base.json",
+    )
+    parser.add_argument("--nodes", type=int, default=1000, help="Device nodes")
+    parser.add_argument("--props", type=int, default=8, help="Properties per node")
+    parser.add_argument("--depth", type=int, default=3, help="Include depth")
+    parser.add_argument("--overlays", type=int, default=10, help="Overlay count")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per phase")
+    parser.add_argument("-o", "--output", help="Write results JSON here")
+    parser.add_argument("--baseline", help="Compare against a stored results JSON")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="Slowdown ratio flagged as a regression (default: 0.10)",
+    )
+    args = parser.parse_args()
+
+    results = run(args)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    for phase, timing in results["phases"].items():
+        line = f"{phase:<16} min {timing['min'] * 1000:9.2f}ms  median {timing['median'] * 1000:9.2f}ms"
+        if "ratio" in timing:
+            line += f"  x{timing['ratio']:.2f}"
+            if phase in regressions:
+                line += "  REGRESSION"
+        print(line)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f"\n{len(regressions)} phase(s) regressed: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
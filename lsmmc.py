@@ -1,173 +1,232 @@
 #!/usr/bin/env python3
-import os, re, sys
-
-
-sdio_devices = {
-    "0020": {"name": "ST-Ericsson", "devices": {"2280": "CW1200"}},
-    "0089": {"name": "Intel Corp.", "devices": {}},
-    "0092": {
-        "name": "C-guys, Inc.",
-        "devices": {
-            "0001": "SD-Link11b WiFi Card (TI ACX100)",
-            "0004": "EW-CG1102GC",
-            "0005": "SD FM Radio 2",
-            "5544": "SD FM Radio",
-        },
-    },
-    "0097": {"name": "Texas Instruments, Inc.", "devices": {"4076": "WL1271"}},
-    "0098": {
-        "name": "Toshiba Corp.",
-        "devices": {
-            "0001": "SD BT Card 1",
-            "0002": "SD BT Card 2",
-            "0003": "SD BT Card 3",
-        },
-    },
-    "0104": {
-        "name": "Socket Communications, Inc.",
-        "devices": {"005e": "SD Scanner", "00c5": "Bluetooth SDIO Card"},
-    },
-    "0271": {
-        "name": "Atheros Communications, Inc.",
-        "devices": {
-            "0108": "AR6001",
-            "0109": "AR6001",
-            "010a": "AR6001",
-            "010b": "AR6001",
-        },
-    },
-    "0296": {"name": "GCT Semiconductor, Inc.", "devices": {"5347": "GDM72xx WiMAX"}},
-    "02d0": {
-        "name": "Broadcom Corp.",
-        "devices": {
-            "044b": "Nintendo Wii WLAN daughter card",
-            "a887": "BCM43143 WLAN card",
-            "a9a6": "BCM43438 combo WLAN and Bluetooth Low Energy (BLE)",
-            "4324": "BCM43241 WLAN card",
-            "4329": "BCM4329 WLAN card",
-            "4330": "BCM4330 WLAN card",
-            "4334": "BCM4334 WLAN card",
-            "a94c": "BCM43340 WLAN card",
-            "a94d": "BCM43341 WLAN card",
-            "4335": "BCM4335/BCM4339 WLAN card",
-            "a962": "BCM43362 WLAN card",
-            "4354": "BCM4354 WLAN card",
-            "aae8": "BCM43752 WLAN card (AP6275s)",
-        },
-    },
-    "02db": {
-        "name": "SyChip Inc.",
-        "devices": {"0002": "Pegasus WLAN SDIO Card (6060SD)"},
-    },
-    "02df": {
-        "name": "Marvell Technology Group Ltd.",
-        "devices": {
-            "9103": "Libertas",
-            "9104": "SD8688 WLAN",
-            "9105": "SD8688 BT",
-            "9116": "SD8786 WLAN",
-            "9119": "SD8787 WLAN",
-            "911a": "SD8787 BT",
-            "911b": "SD8787 BT AMP",
-            "9129": "SD8797 WLAN",
-            "912a": "SD8797 BT",
-            "912e": "SD8897 BT",
-            "912d": "SD8897 WLAN",
-        },
-    },
-    "02fe": {
-        "name": "Spectec Computer Co., Ltd",
-        "devices": {"2128": "SDIO WLAN Card (SDW820)"},
-    },
-    "032a": {
-        "name": "Cambridge Silicon Radio",
-        "devices": {
-            "0001": "UniFi 1",
-            "0002": "UniFi 2",
-            "0007": "UniFi 3",
-            "0008": "UniFi 4",
-        },
-    },
-    "037a": {"name": "MediaTek Inc.", "devices": {"5911": "Spectec WLAN-11b/g"}},
-    "039a": {"name": "Siano Mobile Silicon", "devices": {}},
-    "0501": {
-        "name": "Globalsat Technology Co.",
-        "devices": {"f501": "SD-501 GPS Card"},
-    },
-    "104c": {"name": "Texas Instruments, Inc.", "devices": {"9066": "WL1251"}},
-    "1180": {"name": "Ricoh Co., Ltd", "devices": {"e823": "MMC card reader"}},
-    "13d1": {"name": "AboCom Systems, Inc.", "devices": {"ac02": "SDW11G"}},
-}
-
-
-def read_sys_file(path):
-    try:
-        with open(path, "r") as f:
-            return f.read().strip()
-    except Exception:
+import os, re, sys, json, mmap, time, array, struct, hashlib
+
+import bredos_sysfs as sysfs
+from bredos_uevent import UeventMonitor, read_events
+
+
+IDS_FILE = "/usr/share/lsmmc/sdio.ids"
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "lsmmc"
+)
+
+# ID namespaces of sdio.ids
+SECTION_SDIO, SECTION_SD, SECTION_MMC = 0, 1, 2
+SECTION_PREFIXES = {"S ": SECTION_SD, "M ": SECTION_MMC}
+
+# magic, source size, source mtime_ns, record count
+INDEX_MAGIC = b"SDIOIDX1"
+INDEX_HEADER = struct.Struct("<8sQqI")
+# section, is a device, vendor, device | name offset; sorted by the key bytes
+INDEX_KEY = struct.Struct(">BBHH")
+INDEX_RECORD = struct.Struct(">BBHHI")
+
+
+def parse_ids(path):
+    """
+    Yield (section, vendor, device or None, name) from an sdio.ids file.
+    """
+    section, vendor = SECTION_SDIO, None
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            try:
+                if line.startswith("\t"):
+                    if vendor is None:
+                        continue
+                    num, _, name = line.strip().partition(" ")
+                    yield section, vendor, int(num, 16), name.strip()
+                else:
+                    section = SECTION_PREFIXES.get(line[:2], SECTION_SDIO)
+                    if section != SECTION_SDIO:
+                        line = line[2:]
+                    num, _, name = line.partition(" ")
+                    vendor = int(num, 16)
+                    yield section, vendor, None, name.strip()
+            except ValueError:
+                # Skip malformed lines, and the devices of a malformed vendor
+                if not line.startswith("\t"):
+                    vendor = None
+
+
+def compile_ids(path):
+    """
+    Build the binary index of an sdio.ids file: a header, fixed-size
+    records sorted by key, then the NUL terminated names.
+    """
+    entries = {}
+    for section, vendor, device, name in parse_ids(path):
+        is_device = device is not None
+        entries[(section, is_device, vendor & 0xFFFF, (device or 0) & 0xFFFF)] = name
+
+    st = os.stat(path)
+    records = bytearray()
+    names = bytearray()
+    for key in sorted(entries):
+        records += INDEX_RECORD.pack(*key, len(names))
+        names += entries[key].encode() + b"\0"
+    header = INDEX_HEADER.pack(INDEX_MAGIC, st.st_size, st.st_mtime_ns, len(entries))
+    return header + bytes(records) + bytes(names)
+
+
+class SdioIds:
+    """
+    Name lookups in an mmapped index of sdio.ids, rebuilt in CACHE_DIR
+    whenever the text database changes.
+    """
+
+    def __init__(self, path=IDS_FILE):
+        self.buf = b""
+        self.count = 0
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        digest = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:16]
+        index = os.path.join(CACHE_DIR, f"sdio-{digest}.idx")
+
+        self.buf = self.load(index, st)
+        if self.buf is None:
+            self.buf = compile_ids(path)
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                tmp = f"{index}.{os.getpid()}"
+                with open(tmp, "wb") as f:
+                    f.write(self.buf)
+                os.replace(tmp, index)
+            except OSError:
+                pass
+        self.count = INDEX_HEADER.unpack_from(self.buf)[3]
+        self.names = INDEX_HEADER.size + self.count * INDEX_RECORD.size
+
+    @staticmethod
+    def load(index, st):
+        try:
+            with open(index, "rb") as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        # A truncated or corrupt index is rebuilt like a stale one
+        try:
+            magic, size, mtime, count = INDEX_HEADER.unpack_from(buf)
+            if (magic, size, mtime) != (INDEX_MAGIC, st.st_size, st.st_mtime_ns):
+                raise ValueError("stale index")
+            if len(buf) < INDEX_HEADER.size + count * INDEX_RECORD.size:
+                raise ValueError("truncated index")
+            if count and buf[-1:] != b"\0":
+                raise ValueError("truncated names")
+        except (struct.error, ValueError):
+            buf.close()
+            return None
+        return buf
+
+    def lookup(self, section, vendor, device=None):
+        """
+        Name of a vendor, or of one of its devices, None when unknown.
+        """
+        key = INDEX_KEY.pack(
+            section, device is not None, vendor & 0xFFFF, (device or 0) & 0xFFFF
+        )
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = INDEX_HEADER.size + mid * INDEX_RECORD.size
+            probe = self.buf[offset : offset + INDEX_KEY.size]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                start = self.names + INDEX_RECORD.unpack_from(self.buf, offset)[4]
+                end = self.buf.find(b"\0", start)
+                return self.buf[start:end].decode(errors="replace")
         return None
 
 
+MMC_ATTRIBUTES = (
+    "manfid",
+    "oemid",
+    "serial",
+    "type",
+    "name",
+    "cid",
+    "vendor",
+    "device",
+)
+
+
 def get_mmc_devices():
-    base_path = "/sys/class/mmc_host"
+    base_path = sysfs.path("class", "mmc_host")
     devices = []
 
-    for host in os.listdir(base_path):
+    for host in sysfs.listdir(base_path):
         if not re.match(r"mmc\d+", host):
             continue
         host_path = os.path.join(base_path, host)
         if not os.path.isdir(host_path):
             continue
 
-        for entry in os.listdir(host_path):
-            if not re.match(rf"{host}:\d+", entry):
+        for entry in sysfs.listdir(host_path):
+            if not re.match(rf"{host}:[0-9a-f]+$", entry):
                 continue
 
-            device_path = os.path.join(host_path, entry)
-
-            dev_info = {
-                "host": host,
-                "dev": entry,
-                "manfid": read_sys_file(os.path.join(device_path, "manfid")),
-                "oemid": read_sys_file(os.path.join(device_path, "oemid")),
-                "serial": read_sys_file(os.path.join(device_path, "serial")),
-                "type": read_sys_file(os.path.join(device_path, "type")),
-                "name": read_sys_file(os.path.join(device_path, "name")),
-                "cid": read_sys_file(os.path.join(device_path, "cid")),
-                "vendor": read_sys_file(os.path.join(device_path, "vendor")),
-                "device": read_sys_file(os.path.join(device_path, "device")),
-            }
+            dev_info = {"host": host, "dev": entry}
+            # One directory fd per card, every attribute is read relative to it
+            dev_info.update(
+                sysfs.read_many(os.path.join(host_path, entry), MMC_ATTRIBUTES)
+            )
 
             devices.append(dev_info)
 
     return devices
 
 
-def format_mmc_entry(dev, verbose=False):
+def resolve_mmc_entry(dev, ids=None):
+    """
+    (vendor, device, name) of a card, the IDs as 4 digit hex.
+    """
     is_sdio = dev.get("vendor") and dev.get("device")
-    vendor = dev["vendor"] if is_sdio else dev.get("manfid", "0000")
-    device = dev["device"] if is_sdio else dev.get("oemid", "0000")
+    vendor = dev["vendor"] if is_sdio else dev.get("manfid") or "0000"
+    device = dev["device"] if is_sdio else dev.get("oemid") or "0000"
 
     vendor = vendor[-4:].rjust(4, "0").lower()
     device = device[-4:].rjust(4, "0").lower()
 
     name = dev.get("name") or "Unknown SDIO device"
-    serial = dev.get("serial") or "XXXXXXXX"
 
-    if vendor in sdio_devices:
-        if device in sdio_devices[vendor]["devices"]:
-            name = (
-                sdio_devices[vendor]["name"]
-                + " "
-                + sdio_devices[vendor]["devices"][device]
-            )
+    if ids is not None:
+        if is_sdio:
+            section = SECTION_SDIO
+        else:
+            section = SECTION_SD if dev.get("type") == "SD" else SECTION_MMC
+        try:
+            vendor_id, device_id = int(vendor, 16), int(device, 16)
+        except ValueError:
+            vendor_id = device_id = None
+        if vendor_id is not None:
+            vendor_name = ids.lookup(section, vendor_id)
+            device_name = ids.lookup(section, vendor_id, device_id)
+            if vendor_name and device_name:
+                name = vendor_name + " " + device_name
+            elif vendor_name and not is_sdio:
+                # Cards report their product name, only the maker is looked up
+                name = vendor_name + " " + name
+
+    return vendor, device, name
+
+
+def format_mmc_entry(dev, verbose=False, ids=None):
+    vendor, device, name = resolve_mmc_entry(dev, ids)
+    serial = dev.get("serial") or "XXXXXXXX"
 
     # Extract mmcX → bus number
     bus_match = re.match(r"mmc(\d+)", dev["host"])
     busnum = bus_match.group(1) if bus_match else "0"
 
     # Extract mmcX:00YY → devnum
-    dev_match = re.match(r".+:(\d+)", dev["dev"])
+    dev_match = re.match(r".+:([0-9a-f]+)", dev["dev"])
     devnum = dev_match.group(1) if dev_match else "0000"
 
     line = f"Bus {busnum} Device {devnum} ID {vendor}:{device} {name}"
@@ -176,11 +235,254 @@ def format_mmc_entry(dev, verbose=False):
     return line
 
 
+def uevent_mmc_device(event):
+    """
+    The card of an mmc uevent, shaped like a get_mmc_devices() entry.
+    Only the card's own directory is read, and nothing on removal.
+    """
+    devpath = event.get("DEVPATH", "")
+    dev = os.path.basename(devpath)
+    match = re.match(r"(mmc\d+):[0-9a-f]+$", dev)
+    if not match:
+        return None
+    dev_info = {"host": match.group(1), "dev": dev}
+    dev_info.update(dict.fromkeys(MMC_ATTRIBUTES))
+    if event["ACTION"] == "add":
+        dev_info.update(
+            sysfs.read_many(sysfs.path(devpath.lstrip("/")), MMC_ATTRIBUTES)
+        )
+    dev_info["type"] = dev_info["type"] or event.get("MMC_TYPE")
+    dev_info["name"] = dev_info["name"] or event.get("MMC_NAME")
+    return dev_info
+
+
+def watch(ids, verbose=False, as_json=False, events=None, source=None):
+    """
+    Report cards as they are added or removed. Events come from the kernel,
+    a recorded file (events) or a unix datagram socket (source).
+    """
+    seen = {}
+
+    def emit(event):
+        action = event["ACTION"]
+        if event.get("SUBSYSTEM") != "mmc" or action not in ("add", "remove"):
+            return
+        devpath = event.get("DEVPATH", "")
+        if action == "add":
+            # A card put back in may not be the one read before
+            sysfs.clear()
+            dev = uevent_mmc_device(event)
+            seen[devpath] = dev
+        else:
+            dev = seen.pop(devpath, None) or uevent_mmc_device(event)
+        if dev is None:
+            return
+        if as_json:
+            vendor, device, name = resolve_mmc_entry(dev, ids)
+            record = {"time": time.time(), "action": action}
+            record.update(dev)
+            record.update(id=f"{vendor}:{device}", description=name)
+            print(json.dumps(record), flush=True)
+        else:
+            print(f"{action:<6} {format_mmc_entry(dev, verbose, ids)}", flush=True)
+
+    if events is not None:
+        for event in read_events(events):
+            emit(event)
+        return
+    with UeventMonitor(subsystems={"mmc"}, source=source) as monitor:
+        try:
+            while True:
+                for event in monitor.poll():
+                    emit(event)
+                if monitor.lost:
+                    print("Warning: uevents were lost", file=sys.stderr, flush=True)
+        except KeyboardInterrupt:
+            pass
+
+
+# Leading fields of /sys/block/*/stat: read ios, merges, sectors, ticks,
+# write ios, merges, sectors, ticks, in flight, io ticks, time in queue
+STAT_FIELDS = 11
+SECTOR_SIZE = 512
+
+
+class BlockStat:
+    """
+    The stat file of one card's block device, kept open and re-read with
+    preadv into buffers allocated once.
+    """
+
+    __slots__ = ("card", "block", "fd", "buf", "prev", "cur")
+
+    def __init__(self, card, block):
+        self.card = card
+        self.block = block
+        self.fd = os.open(
+            sysfs.path("block", block, "stat"), os.O_RDONLY | os.O_CLOEXEC
+        )
+        self.buf = bytearray(512)
+        self.prev = array.array("Q", bytes(8 * STAT_FIELDS))
+        self.cur = array.array("Q", bytes(8 * STAT_FIELDS))
+
+    def close(self):
+        os.close(self.fd)
+
+    def read(self):
+        self.prev, self.cur = self.cur, self.prev
+        size = os.preadv(self.fd, [self.buf], 0)
+        for i, field in enumerate(self.buf[:size].split()[:STAT_FIELDS]):
+            self.cur[i] = int(field)
+
+    def rates(self, seconds):
+        """
+        iostat style figures for the time between the last two reads.
+        """
+        d = [max(0, new - old) for old, new in zip(self.prev, self.cur)]
+        reads, writes = d[0], d[4]
+        return {
+            "card": self.card,
+            "device": self.block,
+            "r_iops": reads / seconds,
+            "w_iops": writes / seconds,
+            "r_kbps": d[2] * SECTOR_SIZE / 1024 / seconds,
+            "w_kbps": d[6] * SECTOR_SIZE / 1024 / seconds,
+            "r_await_ms": d[3] / reads if reads else 0.0,
+            "w_await_ms": d[7] / writes if writes else 0.0,
+            "queue_depth": d[10] / 1000 / seconds,
+            "in_flight": self.cur[8],
+            "util": min(100.0, d[9] / 10 / seconds),
+        }
+
+
+def mmc_block_stats(devices):
+    """
+    A BlockStat for every block device of the given cards.
+    """
+    stats = []
+    for dev in devices:
+        card = sysfs.path("class", "mmc_host", dev["host"], dev["dev"])
+        for block in sysfs.listdir(os.path.join(card, "block")):
+            try:
+                stats.append(BlockStat(dev["dev"], block))
+            except OSError:
+                continue
+    return stats
+
+
+def print_stats(samples):
+    print(
+        f"{'DEVICE':<10} {'CARD':<10} {'r/s':>8} {'w/s':>8} {'rkB/s':>10} "
+        f"{'wkB/s':>10} {'r_await':>8} {'w_await':>8} {'aqu-sz':>7} {'%util':>6}"
+    )
+    for s in samples:
+        print(
+            f"{s['device']:<10} {s['card']:<10} {s['r_iops']:>8.1f} {s['w_iops']:>8.1f} "
+            f"{s['r_kbps']:>10.1f} {s['w_kbps']:>10.1f} {s['r_await_ms']:>8.2f} "
+            f"{s['w_await_ms']:>8.2f} {s['queue_depth']:>7.2f} {s['util']:>6.1f}"
+        )
+    print()
+
+
+def stats(interval=1.0, as_json=False, count=None):
+    """
+    Sample the cards' block devices every interval seconds, count times or
+    until interrupted.
+    """
+    devices = mmc_block_stats(get_mmc_devices())
+    if not devices:
+        print("No mmc block devices found", file=sys.stderr)
+        return
+    try:
+        for dev in devices:
+            dev.read()
+        last = time.monotonic()
+        taken = 0
+        while count is None or taken < count:
+            time.sleep(interval)
+            now = time.monotonic()
+            for dev in devices:
+                dev.read()
+            samples = [dev.rates(now - last) for dev in devices]
+            last = now
+            taken += 1
+            if as_json:
+                stamp = time.time()
+                for sample in samples:
+                    sample["time"] = stamp
+                    print(json.dumps(sample), flush=True)
+            else:
+                print_stats(samples)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for dev in devices:
+            dev.close()
+
+
+def option(args, name, default=None):
+    if name in args[:-1]:
+        return args[args.index(name) + 1]
+    return default
+
+
+USAGE = """Usage: lsmmc [-v] [--ids FILE] [--sysfs-root PATH]
+       lsmmc --watch [--json] [--events FILE | --uevent-socket PATH]
+       lsmmc --stats [INTERVAL] [--count N] [--json]
+
+  -v                   Show card serial numbers
+  --ids FILE           Name database (default: {ids})
+  --sysfs-root PATH    Read a captured or fake sysfs instead of /sys
+  --watch              Report cards as they are added or removed
+  --json               With --watch or --stats, print one JSON object per
+                       event or per device and sample
+  --events FILE        With --watch, replay events recorded by
+                       `udevadm monitor --kernel --property`
+  --uevent-socket PATH With --watch, take uevents from a unix datagram
+                       socket bound at PATH instead of the kernel
+  --stats [INTERVAL]   Show IOPS, throughput, latency and queue depth of
+                       the cards' block devices every INTERVAL seconds
+                       (default: 1)
+  --count N            With --stats, stop after N samples"""
+
+
 def main():
-    verbose = "-v" in sys.argv[1:]
+    args = sys.argv[1:]
+    if "-h" in args or "--help" in args:
+        print(USAGE.format(ids=IDS_FILE))
+        return
+    if "--sysfs-root" in args[:-1]:
+        sysfs.set_root(option(args, "--sysfs-root"))
+    verbose = "-v" in args
+    ids = SdioIds(option(args, "--ids", IDS_FILE))
+    if "--watch" in args:
+        try:
+            watch(
+                ids,
+                verbose,
+                "--json" in args,
+                option(args, "--events"),
+                option(args, "--uevent-socket"),
+            )
+        except OSError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+    if "--stats" in args:
+        interval = option(args, "--stats", "1")
+        try:
+            interval = float(interval)
+        except ValueError:
+            interval = 1.0
+        count = option(args, "--count")
+        if count is not None and not count.isdigit():
+            print("Error: --count needs a number", file=sys.stderr)
+            sys.exit(1)
+        stats(interval, "--json" in args, int(count) if count else None)
+        return
     devices = get_mmc_devices()
     for dev in devices:
-        print(format_mmc_entry(dev, verbose=verbose))
+        print(format_mmc_entry(dev, verbose=verbose, ids=ids))
 
 
 if __name__ == "__main__":
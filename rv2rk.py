@@ -5,15 +5,30 @@ import sys
 import time
 import argparse
 
+import bredos_sysfs as sysfs
+from bredos_uevent import UeventMonitor, read_events
+
 FASTBOOT_BIN = "/usr/bin/fastboot"
 DEFAULT_FSBL = "/usr/share/rv2rk/FSBL.bin"
 DEFAULT_UBOOT = "/usr/share/rv2rk/u-boot.itb"
+REENUMERATE_TIMEOUT = 10
+
+# USB ids of the boot stages, with the strings `fastboot devices` used to
+# show for boards that enumerate with other ids
+MODES = {
+    "dfu": ({("361c", "1001")}, "dfu-device"),
+    "fastboot": ({("18d1", "d00d")}, "Android Fastboot"),
+}
+USB_ATTRIBUTES = ("idVendor", "idProduct", "manufacturer", "product", "serial")
 
 
 def run_command(cmd, capture_output=False):
     try:
         result = subprocess.run(
-            cmd, shell=True, text=True, capture_output=capture_output
+            cmd,
+            shell=isinstance(cmd, str),
+            text=True,
+            capture_output=capture_output,
         )
         return result
     except subprocess.CalledProcessError:
@@ -35,12 +50,93 @@ def ensure_fastboot():
         print("Installation successful.")
 
 
+def device_mode(attrs):
+    """
+    The boot stage a USB device is in, by VID:PID and then by its strings.
+    """
+    usb_id = (
+        (attrs.get("idVendor") or "").lower(),
+        (attrs.get("idProduct") or "").lower(),
+    )
+    for mode, (ids, _) in MODES.items():
+        if usb_id in ids:
+            return mode
+    strings = [attrs.get(key) for key in ("manufacturer", "product", "serial")]
+    for mode, (_, name) in MODES.items():
+        if name in strings:
+            return mode
+    return None
+
+
+def find_device():
+    """
+    (mode, sysfs path) of the first board found on the USB bus, or None.
+    """
+    base = sysfs.path("bus", "usb", "devices")
+    for entry in sysfs.listdir(base):
+        # Interfaces are named bus-port:config.interface
+        if ":" in entry:
+            continue
+        path = os.path.join(base, entry)
+        mode = device_mode(sysfs.read_many(path, USB_ATTRIBUTES))
+        if mode is not None:
+            return mode, path
+    return None
+
+
+def event_mode(event):
+    """
+    The boot stage of a USB device that was just added, from the uevent's
+    PRODUCT (vid/pid/bcd in hex), falling back to its sysfs strings.
+    """
+    if event.get("ACTION") not in ("add", "bind"):
+        return None
+    if event.get("SUBSYSTEM") != "usb" or event.get("DEVTYPE") != "usb_device":
+        return None
+    vendor, _, rest = event.get("PRODUCT", "").partition("/")
+    product = rest.partition("/")[0]
+    if vendor and product:
+        mode = device_mode({"idVendor": vendor.zfill(4), "idProduct": product.zfill(4)})
+        if mode is not None:
+            return mode
+    # Reused paths would otherwise answer with what the old device had
+    sysfs.clear()
+    return device_mode(
+        sysfs.read_many(
+            sysfs.path(event.get("DEVPATH", "").lstrip("/")), USB_ATTRIBUTES
+        )
+    )
+
+
+def wait_for_device(mode, monitor, timeout=REENUMERATE_TIMEOUT, events=None):
+    """
+    Wait for a board in mode to appear, returning as soon as its uevent
+    arrives. events replays a recorded file instead of the monitor.
+    """
+    if events is not None:
+        return any(event_mode(event) == mode for event in read_events(events))
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        for event in monitor.poll(remaining):
+            if event_mode(event) == mode:
+                return True
+        if monitor.lost:
+            # Its uevent may have been dropped, look on the bus instead
+            sysfs.clear()
+            found = find_device()
+            if found is not None and found[0] == mode:
+                return True
+
+
 def flash_stage_2(uboot_path):
     print(f"Staging U-Boot: {uboot_path}")
-    run_command(f"{FASTBOOT_BIN} stage {uboot_path}")
+    run_command([FASTBOOT_BIN, "stage", uboot_path])
 
     print("Continuing boot...")
-    run_command(f"{FASTBOOT_BIN} continue")
+    run_command([FASTBOOT_BIN, "continue"])
 
     print("Process completed successfully.")
     sys.exit(0)
@@ -60,39 +156,84 @@ def main():
         default=DEFAULT_UBOOT,
         help=f"Path to U-Boot image (default: {DEFAULT_UBOOT})",
     )
+    parser.add_argument(
+        "--detect",
+        action="store_true",
+        help="Only report the mode of the connected device",
+    )
+    parser.add_argument(
+        "--sysfs-root",
+        metavar="PATH",
+        help="Read a captured or fake sysfs instead of /sys",
+    )
+    parser.add_argument(
+        "--events",
+        metavar="FILE",
+        help="Replay re-enumeration uevents recorded by "
+        "`udevadm monitor --kernel --property`",
+    )
+    parser.add_argument(
+        "--uevent-socket",
+        metavar="PATH",
+        help="Take uevents from a unix datagram socket bound at PATH",
+    )
     args = parser.parse_args()
 
-    ensure_fastboot()
+    if args.sysfs_root:
+        sysfs.set_root(args.sysfs_root)
 
     print("Checking device status...")
-    dev_proc = run_command(f"{FASTBOOT_BIN} devices", capture_output=True)
-    output = dev_proc.stdout if dev_proc else ""
+    found = find_device()
+    mode = found[0] if found else None
+
+    if args.detect:
+        if mode is None:
+            print("No compatible device detected.")
+            sys.exit(1)
+        print(f"Device detected in {mode} mode at {found[1]}.")
+        return
 
-    if "Android Fastboot" in output:
+    if mode is not None:
+        ensure_fastboot()
+
+    if mode == "fastboot":
         print("Device already detected in Android Fastboot mode.")
         flash_stage_2(args.uboot)
-    elif "dfu-device" in output:
+    elif mode == "dfu":
         print("Device detected in DFU mode.")
 
         print(f"Staging FSBL: {args.fsbl}")
-        run_command(f"{FASTBOOT_BIN} stage {args.fsbl}")
-
-        print("Continuing boot...")
-        run_command(f"{FASTBOOT_BIN} continue")
+        run_command([FASTBOOT_BIN, "stage", args.fsbl])
+
+        # Listening before the board resets, so its return can't be missed
+        monitor = None
+        try:
+            if args.events is None:
+                monitor = UeventMonitor(subsystems={"usb"}, source=args.uevent_socket)
+        except OSError as e:
+            print(f"Error: could not listen for uevents: {e}", file=sys.stderr)
+            sys.exit(1)
 
-        print("Waiting for device to re-enumerate (10s timeout)...")
-        start_time = time.time()
+        try:
+            print("Continuing boot...")
+            run_command([FASTBOOT_BIN, "continue"])
 
-        while time.time() - start_time < 10:
-            check_proc = run_command(f"{FASTBOOT_BIN} devices", capture_output=True)
-            if check_proc and "Android Fastboot" in check_proc.stdout:
-                print("Device detected in Android Fastboot mode.")
-                flash_stage_2(args.uboot)
+            print(
+                f"Waiting for device to re-enumerate ({REENUMERATE_TIMEOUT}s timeout)..."
+            )
+            appeared = wait_for_device(
+                "fastboot", monitor, REENUMERATE_TIMEOUT, args.events
+            )
+        finally:
+            if monitor is not None:
+                monitor.close()
 
-            time.sleep(0.5)
+        if appeared:
+            print("Device detected in Android Fastboot mode.")
+            flash_stage_2(args.uboot)
 
         print(
-            "Timeout: Device did not appear in 'Android Fastboot' mode within 10 seconds."
+            f"Timeout: Device did not appear in 'Android Fastboot' mode within {REENUMERATE_TIMEOUT} seconds."
         )
         sys.exit(1)
 
@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 
+import os
+import json
+import socket
 import argparse
 import subprocess
 from pathlib import Path
@@ -7,18 +10,84 @@ import sys
 
 CONFIG_PATH = Path.home() / ".config/sleepctl.conf"
 SERVICE_NAME = "sleepctl.service"
-
-
-def write_config(mode, processes) -> None:
+SERVICE_LINK = Path.home() / ".config/systemd/user/default.target.wants" / SERVICE_NAME
+CONTROL_PATH = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or f"/run/user/{os.getuid()}", "sleepctl.sock"
+)
+THRESHOLDS = ("cpu", "disk", "net", "hold")
+
+
+def check_thresholds(text: str) -> bool:
+    for item in text.split(","):
+        key, sep, value = item.partition("=")
+        if not sep or key.strip() not in THRESHOLDS:
+            return False
+        try:
+            if float(value) < 0:
+                return False
+        except ValueError:
+            return False
+    return True
+
+
+def write_config(mode, processes, activity="") -> None:
     CONFIG_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with open(CONFIG_PATH, "w") as f:
+    # Written aside and renamed over, the daemon never reads half a file
+    tmp = CONFIG_PATH.with_name(CONFIG_PATH.name + ".tmp")
+    with open(tmp, "w") as f:
         f.write(f"mode={mode}\n")
         if processes:
             f.write(f"processes={','.join(processes)}\n")
+        if activity:
+            f.write(f"activity={activity}\n")
+    os.replace(tmp, CONFIG_PATH)
+
+
+def daemon_request(request: dict) -> dict | None:
+    """
+    Ask the running sleepctld, None when it isn't running.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(2.0)
+            sock.connect(CONTROL_PATH)
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            data = b""
+            while not data.endswith(b"\n"):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        return json.loads(data)
+    except (OSError, ValueError):
+        return None
 
 
 def read_status() -> None:
-    subprocess.run(["systemctl", "--user", "status", SERVICE_NAME])
+    status = daemon_request({"cmd": "status"})
+    enabled = "enabled" if SERVICE_LINK.exists() else "disabled"
+    if status is None:
+        print(f"sleepctld is not running (service {enabled}).")
+        return
+    mode = status["mode"]
+    if status["processes"]:
+        mode += " " + ",".join(status["processes"])
+    if status.get("thresholds"):
+        mode += " " + status["thresholds"]
+    print(f"sleepctld is running (service {enabled}).")
+    print(f"Mode: {mode}")
+    if status["inhibiting"]:
+        print(f"Inhibiting: {status['why']} [{status['what']}]")
+    else:
+        print("Inhibiting: nothing")
+    if status["watched"]:
+        print("Watched processes running: " + ", ".join(map(str, status["watched"])))
+    levels = status.get("activity")
+    if levels:
+        print(
+            f"Activity: cpu {levels['cpu']}%, disk {levels['disk']} KiB/s,"
+            f" net {levels['net']} KiB/s"
+        )
 
 
 def systemctl_user(*args, capture=False) -> str | None:
@@ -30,12 +99,10 @@ def systemctl_user(*args, capture=False) -> str | None:
 
 
 def toggle_service() -> bool:
-    enabled = systemctl_user("is-enabled", SERVICE_NAME, capture=True)
-    if "enabled" in enabled.stdout:
+    if SERVICE_LINK.exists():
         systemctl_user("disable", "--now", SERVICE_NAME)
         return False
     else:
-        systemctl_user("daemon-reexec")
         systemctl_user("enable", "--now", SERVICE_NAME)
         return True
 
@@ -55,7 +122,7 @@ def main() -> None:
         help="Stop and disable the inhibitor service",
     )
     parser.add_argument(
-        "-s", "--status", action="store_true", help="Show systemd user service status"
+        "-s", "--status", action="store_true", help="Show the daemon's current state"
     )
     parser.add_argument(
         "-t", "--toggle", action="store_true", help="Toggle the service state"
@@ -65,8 +132,9 @@ def main() -> None:
         "-m",
         "--mode",
         nargs="+",
-        metavar=("MODE", "PROCS"),
-        help="Set mode: always | lid | button | processes proc1,proc2,...",
+        metavar=("MODE", "ARGS"),
+        help="Set mode: always | lid | button | processes proc1,proc2,... | "
+        "activity [cpu=%%,disk=KiB/s,net=KiB/s,hold=s]",
     )
 
     args = parser.parse_args()
@@ -83,28 +151,49 @@ def main() -> None:
         if len(args.mode) == 1:
             mode = args.mode[0]
             processes = []
-            if mode not in {"always", "lid", "button"}:
+            activity = ""
+            if mode not in {"always", "lid", "button", "activity"}:
                 print(
                     "Error: '--mode processes' requires a process list.",
                     file=sys.stderr,
                 )
                 sys.exit(1)
         elif len(args.mode) == 2:
-            mode, process_str = args.mode
-            if mode != "processes":
+            mode, mode_args = args.mode
+            processes = []
+            activity = ""
+            if mode == "processes":
+                processes = [p.strip() for p in mode_args.split(",") if p.strip()]
+            elif mode == "activity":
+                activity = mode_args
+                if not check_thresholds(activity):
+                    print(
+                        f"Error: Invalid activity thresholds '{activity}'.",
+                        file=sys.stderr,
+                    )
+                    sys.exit(1)
+            else:
                 print(
                     f"Error: Unsupported mode '{mode}' with arguments.", file=sys.stderr
                 )
                 sys.exit(1)
-            processes = [p.strip() for p in process_str.split(",") if p.strip()]
         else:
             print("Error: Too many arguments to --mode", file=sys.stderr)
             sys.exit(1)
 
-        write_config(mode=mode, processes=processes)
+        write_config(mode=mode, processes=processes, activity=activity)
+        reply = daemon_request(
+            {"cmd": "set", "mode": mode, "processes": processes, "activity": activity}
+        )
+        if reply is None:
+            print(f"Mode set to {mode}, applied when sleepctld starts.")
+        elif not reply.get("ok"):
+            print(f"Error: {reply.get('error')}", file=sys.stderr)
+            sys.exit(1)
+        else:
+            print(f"Mode set to {mode}.")
 
     if args.enable:
-        systemctl_user("daemon-reexec")
         systemctl_user("enable", "--now", SERVICE_NAME)
         print("Enabled.")
 
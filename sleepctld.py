@@ -0,0 +1,969 @@
+#!/usr/bin/env python3
+
+"""
+Sleep inhibition daemon, enforces the rules written by sleepctl.
+
+This script is part of BredOS-Tools, licenced under the GPL-3.0 licence.
+
+Bill Sideris <bill88t@bredos.org>
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import array
+import struct
+from pathlib import Path
+
+from bredos_dbus import Connection, DBusError
+
+CONFIG_PATH = Path.home() / ".config/sleepctl.conf"
+CONTROL_PATH = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or f"/run/user/{os.getuid()}", "sleepctl.sock"
+)
+PEERCRED = struct.Struct("3i")
+# Socket of `sleepctld --relay`, the system service forwarding proc
+# connector events to user daemons, which can't subscribe themselves
+RELAY_PATH = "/run/sleepctl-proc.sock"
+# Sent by the relay once it follows the names a client registered
+RELAY_READY = b'{"ok": true}'
+# The relay exits after this long without clients, systemd restarts it
+RELAY_IDLE = 30.0
+# Socket buffers of the relay, builds fork thousands of times a second
+RELAY_BUFFER = 4 * 1024 * 1024
+SO_RCVBUFFORCE = 33
+# How often the config is checked, and processes rescanned without events
+SCAN_INTERVAL = 5.0
+
+EVERYTHING = "handle-lid-switch:handle-power-key:handle-suspend-key:idle:sleep"
+MODES = {
+    "always": (EVERYTHING, "Rule: Always"),
+    "lid": ("handle-lid-switch:sleep", "Rule: Lid"),
+    "button": ("handle-power-key:handle-suspend-key:idle:sleep", "Rule: Power Button"),
+    "processes": (EVERYTHING, "Rule: Processes"),
+    "activity": (EVERYTHING, "Rule: Activity"),
+}
+
+# Activity thresholds: CPU busy %, disk and network KiB/s, and the seconds
+# everything has to stay quiet before the lock is released. 0 disables one.
+ACTIVITY_DEFAULTS = {"cpu": 50.0, "disk": 1024.0, "net": 256.0, "hold": 60.0}
+SAMPLE_INTERVAL = 5.0
+# Consecutive busy samples needed to take the lock, quiet is below half
+RISE_SAMPLES = 2
+SECTOR_SIZE = 512
+
+# linux/connector.h and linux/cn_proc.h
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+NLMSG_DONE = 3
+PROC_CN_MCAST_LISTEN = 1
+PROC_CN_MCAST_IGNORE = 2
+PROC_EVENT_NONE = 0x0
+PROC_EVENT_FORK = 0x1
+PROC_EVENT_EXEC = 0x2
+PROC_EVENT_COMM = 0x200
+PROC_EVENT_EXIT = 0x80000000
+NLMSGHDR = struct.Struct("=IHHII")
+CN_MSG = struct.Struct("=IIIIHH")
+# what, cpu, timestamp, then the event data
+PROC_EVENT = struct.Struct("=IIQ")
+COMM_SIZE = 16
+
+LOGIND = "org.freedesktop.login1"
+LOGIND_PATH = "/org/freedesktop/login1"
+LOGIND_MANAGER = "org.freedesktop.login1.Manager"
+
+
+def log(message: str) -> None:
+    print(message, flush=True)
+
+
+def read_config(path: Path = CONFIG_PATH) -> dict:
+    """
+    The KEY=VALUE config written by sleepctl, with the defaults filled in.
+    """
+    config = {"mode": "always", "processes": "", "activity": ""}
+    try:
+        text = path.read_text()
+    except OSError:
+        return config
+    for line in text.splitlines():
+        key, sep, value = line.strip().partition("=")
+        if sep and not key.startswith("#"):
+            config[key.strip()] = value.strip().strip("\"'")
+    return config
+
+
+def parse_thresholds(text: str) -> dict:
+    """
+    Activity thresholds from "cpu=50,disk=2048,...", unset ones keep their
+    default. Raises ValueError on unknown keys or bad numbers.
+    """
+    thresholds = dict(ACTIVITY_DEFAULTS)
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        key, sep, value = item.partition("=")
+        key = key.strip()
+        if not sep or key not in thresholds:
+            raise ValueError(f"unknown activity threshold '{item.strip()}'")
+        thresholds[key] = float(value)
+        if thresholds[key] < 0:
+            raise ValueError(f"negative activity threshold '{item.strip()}'")
+    return thresholds
+
+
+class Inhibitor:
+    """
+    A logind inhibitor lock, held as the fd Manager.Inhibit() returns.
+    """
+
+    def __init__(self) -> None:
+        self.bus = None
+        self.fd = None
+        self.what = None
+        self.why = None
+
+    def inhibit(self, what: str, why: str) -> int:
+        # Retry once on a fresh connection, the bus may have restarted
+        for attempt in range(2):
+            try:
+                if self.bus is None:
+                    self.bus = Connection()
+                (index,), fds = self.bus.call(
+                    LOGIND,
+                    LOGIND_PATH,
+                    LOGIND_MANAGER,
+                    "Inhibit",
+                    "ssss",
+                    (what, "sleepctld", why, "block"),
+                )
+                break
+            except OSError:
+                if self.bus is not None:
+                    self.bus.close()
+                    self.bus = None
+                if attempt:
+                    raise
+        fd = fds.pop(index)
+        for other in fds:
+            os.close(other)
+        return fd
+
+    def start(self, what: str, why: str) -> None:
+        if self.fd is not None and (what, why) == (self.what, self.why):
+            return
+        try:
+            fd = self.inhibit(what, why)
+        except (OSError, DBusError, ValueError, IndexError) as e:
+            log(f"Could not take inhibitor lock: {e}")
+            return
+        # The new lock is held before the old one goes, sleep never slips through
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd, self.what, self.why = fd, what, why
+        log(f"Inhibitor started: {why} [{what}]")
+
+    def stop(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            log(f"Inhibitor stopped: {self.why}")
+        self.fd = self.what = self.why = None
+
+    def close(self) -> None:
+        self.stop()
+        if self.bus is not None:
+            self.bus.close()
+            self.bus = None
+
+
+def process_name(pid: int) -> str | None:
+    try:
+        with open(f"/proc/{pid}/comm", "rb") as f:
+            return f.read().rstrip(b"\n").decode(errors="replace")
+    except OSError:
+        return None
+
+
+def scan_processes(names: set) -> set:
+    """
+    Pids of every process whose name is in names, in a single pass over /proc.
+    """
+    found = set()
+    for entry in os.scandir("/proc"):
+        if entry.name.isdigit() and process_name(entry.name) in names:
+            found.add(int(entry.name))
+    return found
+
+
+def follow(pids: set, names: set, what: int, data: bytes) -> bool:
+    """
+    Apply one proc connector event to pids, the running processes named in
+    names. Returns whether the event concerned them.
+    """
+    if what == PROC_EVENT_FORK:
+        # Forks from any thread of a watched process count
+        _, parent_tgid, child, child_tgid = struct.unpack_from("=IIII", data)
+        if parent_tgid in pids and child == child_tgid:
+            pids.add(child)
+            return True
+    elif what in (PROC_EVENT_EXEC, PROC_EVENT_COMM):
+        pid, tgid = struct.unpack_from("=II", data)
+        if what == PROC_EVENT_COMM:
+            # A thread renaming itself leaves the process name alone
+            if pid != tgid:
+                return False
+            name = data[8 : 8 + COMM_SIZE].split(b"\0")[0].decode(errors="replace")
+        else:
+            name = process_name(tgid)
+        if name in names:
+            pids.add(tgid)
+            return True
+        if tgid in pids:
+            pids.discard(tgid)
+            return True
+    elif what == PROC_EVENT_EXIT:
+        pid, tgid = struct.unpack_from("=II", data)
+        if pid == tgid and tgid in pids:
+            pids.discard(tgid)
+            return True
+    return False
+
+
+class ProcConnector:
+    """
+    Process fork, exec, rename and exit events from the netlink proc
+    connector. Subscribing needs CAP_NET_ADMIN, OSError is raised without.
+    """
+
+    def __init__(self) -> None:
+        self.sock = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR
+        )
+        try:
+            self.sock.bind((0, CN_IDX_PROC))
+            self.control(PROC_CN_MCAST_LISTEN)
+            # The kernel acknowledges the subscription, with an errno on failure
+            self.sock.settimeout(1.0)
+            err = None
+            while err is None:
+                for what, data in self.parse(self.sock.recv(4096)):
+                    if what == PROC_EVENT_NONE:
+                        err = struct.unpack_from("=I", data)[0]
+            if err:
+                raise OSError(err, os.strerror(err))
+            self.sock.setblocking(False)
+        except (OSError, struct.error):
+            self.sock.close()
+            raise
+
+    def control(self, op: int) -> None:
+        size = NLMSGHDR.size + CN_MSG.size + 4
+        self.sock.send(
+            NLMSGHDR.pack(size, NLMSG_DONE, 0, 0, 0)
+            + CN_MSG.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, 4, 0)
+            + struct.pack("=I", op)
+        )
+
+    def close(self) -> None:
+        try:
+            self.control(PROC_CN_MCAST_IGNORE)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    @staticmethod
+    def parse(data: bytes) -> list:
+        events = []
+        offset = 0
+        while offset + NLMSGHDR.size <= len(data):
+            length = NLMSGHDR.unpack_from(data, offset)[0]
+            if length < NLMSGHDR.size:
+                break
+            start = offset + NLMSGHDR.size + CN_MSG.size
+            what = PROC_EVENT.unpack_from(data, start)[0]
+            events.append((what, data[start + PROC_EVENT.size : offset + length]))
+            offset += (length + 3) & ~3
+        return events
+
+    def receive(self) -> list:
+        """
+        Every queued message, raises OSError(ENOBUFS) if some were lost.
+        """
+        messages = []
+        while True:
+            try:
+                messages.append(self.sock.recv(4096))
+            except (BlockingIOError, InterruptedError):
+                return messages
+
+    def events(self) -> list:
+        """
+        Every queued (what, data), raises OSError(ENOBUFS) if some were lost.
+        """
+        return [event for data in self.receive() for event in self.parse(data)]
+
+
+class RelayConnector(ProcConnector):
+    """
+    Proc connector messages forwarded by `sleepctld --relay`, which holds
+    CAP_NET_ADMIN on behalf of the unprivileged user daemons. Only the
+    events about processes named in names are passed on.
+    """
+
+    def __init__(self, names: set, path: str = RELAY_PATH) -> None:
+        self.names = names
+        self.path = path
+        self.sock = socket.socket(
+            socket.AF_UNIX, socket.SOCK_SEQPACKET | socket.SOCK_CLOEXEC
+        )
+        try:
+            self.sock.connect(path)
+            self.sock.send(json.dumps(sorted(names)).encode())
+            # The relay answers once it follows the names, scan only after
+            self.sock.settimeout(1.0)
+            reply = self.sock.recv(4096)
+            self.sock.setblocking(False)
+        except OSError:
+            self.sock.close()
+            raise
+        if reply != RELAY_READY:
+            self.sock.close()
+            raise OSError(errno.EPROTO, "relay did not accept the names")
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def receive(self) -> list:
+        messages = []
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                return messages
+            if not data:
+                # Dropped by the relay for falling behind, or it restarted
+                self.sock.close()
+                self.__init__(self.names, self.path)
+                raise OSError(errno.ENOBUFS, "relay connection lost")
+            messages.append(data)
+
+
+class ProcessWatch:
+    """
+    The set of running processes named in names, seeded by one /proc scan.
+
+    With the proc connector the set follows fork, exec and exit events as
+    they happen, subscribed directly when privileged and through the
+    system relay otherwise. Without either, pidfds report exits and new
+    processes are picked up by rescanning every SCAN_INTERVAL.
+    """
+
+    def __init__(self, names: set) -> None:
+        self.names = {name[: COMM_SIZE - 1] for name in names}
+        try:
+            self.connector = ProcConnector()
+        except OSError:
+            try:
+                self.connector = RelayConnector(self.names)
+            except OSError as e:
+                log(
+                    f"Proc connector unavailable ({e}), scanning every {SCAN_INTERVAL}s"
+                )
+                self.connector = None
+        self.pids = set()
+        self.pidfds = {}
+        self.next_scan = None
+        # Subscribed first, so nothing starting during the scan is missed
+        self.rescan()
+
+    @property
+    def active(self) -> bool:
+        return bool(self.pids)
+
+    @property
+    def timeout(self) -> float | None:
+        if self.connector is not None:
+            return None
+        return max(0.0, self.next_scan - time.monotonic())
+
+    def close(self) -> None:
+        if self.connector is not None:
+            self.connector.close()
+        for fd in self.pidfds.values():
+            os.close(fd)
+        self.pidfds = {}
+
+    def fds(self) -> list:
+        if self.connector is not None:
+            return [self.connector]
+        return list(self.pidfds.values())
+
+    def rescan(self) -> None:
+        self.pids = scan_processes(self.names)
+        if self.connector is not None:
+            return
+        self.next_scan = time.monotonic() + SCAN_INTERVAL
+        for pid in list(self.pidfds):
+            if pid not in self.pids:
+                os.close(self.pidfds.pop(pid))
+        for pid in self.pids - self.pidfds.keys():
+            try:
+                self.pidfds[pid] = os.pidfd_open(pid)
+            except OSError:
+                self.pids.discard(pid)
+
+    def handle(self, ready: list) -> None:
+        if self.connector is None:
+            for pid, fd in list(self.pidfds.items()):
+                if fd in ready:
+                    os.close(self.pidfds.pop(pid))
+                    self.pids.discard(pid)
+            if time.monotonic() >= self.next_scan:
+                self.rescan()
+            return
+        try:
+            events = self.connector.events()
+        except OSError as e:
+            if e.errno != errno.ENOBUFS:
+                log(f"Proc connector lost ({e}), scanning every {SCAN_INTERVAL}s")
+                self.connector = None
+            # Events were dropped, the set can't be trusted
+            self.rescan()
+            return
+        for what, data in events:
+            follow(self.pids, self.names, what, data)
+
+    def status(self) -> dict:
+        return {"watched": sorted(self.pids)}
+
+
+def physical_devices(directory: str) -> set:
+    """
+    Names of the entries in a sysfs class directory backed by hardware,
+    which leaves out loop, zram, device mapper, loopback and bridges that
+    would count the same traffic twice.
+    """
+    return {
+        entry.encode()
+        for entry in os.listdir(directory)
+        if os.path.exists(os.path.join(directory, entry, "device"))
+    }
+
+
+def read_number(buf: bytearray, pos: int, end: int) -> tuple:
+    """
+    The first decimal number in buf[pos:end], and the position after it.
+    """
+    while pos < end and not 48 <= buf[pos] <= 57:
+        pos += 1
+    value = 0
+    while pos < end and 48 <= buf[pos] <= 57:
+        value = value * 10 + buf[pos] - 48
+        pos += 1
+    return value, pos
+
+
+def skip_field(buf: bytearray, pos: int, end: int) -> int:
+    """
+    Position after the next whitespace separated field of buf[pos:end].
+    """
+    while pos < end and buf[pos] in b" \t":
+        pos += 1
+    while pos < end and buf[pos] not in b" \t":
+        pos += 1
+    return pos
+
+
+class ActivityWatch:
+    """
+    Active while the system is busy, judged from the deltas of /proc/stat,
+    /proc/diskstats and /proc/net/dev every SAMPLE_INTERVAL.
+
+    The files stay open, are re-read with preadv into buffers allocated
+    once and the counters are parsed in place, without copying the files
+    or splitting them into lines. The lock is taken after RISE_SAMPLES
+    busy samples in a row and released once every figure stayed below half
+    its threshold for the hold time, so a build pausing to link doesn't
+    let the system sleep.
+    """
+
+    FILES = ("/proc/stat", "/proc/diskstats", "/proc/net/dev")
+
+    def __init__(self, thresholds: dict) -> None:
+        self.thresholds = thresholds
+        self.files = []
+        try:
+            for path in self.FILES:
+                self.files.append(os.open(path, os.O_RDONLY | os.O_CLOEXEC))
+        except OSError:
+            self.close()
+            raise
+        self.bufs = [bytearray(4096), bytearray(65536), bytearray(65536)]
+        # Lines of the disks and links counted, redone when the physical
+        # devices change or lines of other devices shift them
+        self.disk_rows = self.link_rows = frozenset()
+        self.disk_key = self.link_key = None
+        # cpu busy jiffies, cpu total jiffies, disk sectors, network bytes
+        self.prev = array.array("Q", bytes(32))
+        self.cur = array.array("Q", bytes(32))
+        self.levels = {"cpu": 0.0, "disk": 0.0, "net": 0.0}
+        self.busy_samples = 0
+        self.quiet_since = None
+        self.active = False
+        self.last = time.monotonic()
+        self.next_sample = self.last + SAMPLE_INTERVAL
+        self.sample()
+
+    @property
+    def timeout(self) -> float:
+        return max(0.0, self.next_sample - time.monotonic())
+
+    def close(self) -> None:
+        for fd in self.files:
+            os.close(fd)
+        self.files = []
+
+    def fds(self) -> list:
+        return []
+
+    def read(self, index: int) -> int:
+        """
+        Re-read one file into its buffer, returns the size read.
+        """
+        buf = self.bufs[index]
+        size = os.preadv(self.files[index], [buf], 0)
+        # Only grows when the file outgrew the buffer, a new disk or link
+        while size == len(buf):
+            buf = self.bufs[index] = bytearray(len(buf) * 2)
+            size = os.preadv(self.files[index], [buf], 0)
+        return size
+
+    def rows(self, index: int, size: int, names: set) -> frozenset:
+        """
+        Line numbers of the devices in names, only worked out again when
+        the names or the number of lines change.
+        """
+        buf = self.bufs[index]
+        rows = set()
+        pos = row = 0
+        while pos < size:
+            eol = buf.find(b"\n", pos, size)
+            eol = size if eol < 0 else eol
+            line = bytes(buf[pos:eol])
+            if index == 1:
+                fields = line.split()
+                name = fields[2] if len(fields) > 2 else b""
+            else:
+                name = line.partition(b":")[0].strip()
+            if name in names:
+                rows.add(row)
+            pos = eol + 1
+            row += 1
+        return frozenset(rows)
+
+    def sample(self) -> None:
+        """
+        Read the counters, parsed in place from the buffers.
+        """
+        self.prev, self.cur = self.cur, self.prev
+        cur = self.cur
+
+        # cpu  user nice system idle iowait irq softirq steal ...
+        size = self.read(0)
+        buf = self.bufs[0]
+        eol = buf.find(b"\n", 0, size)
+        pos = 3
+        total = idle = 0
+        for i in range(8):
+            value, pos = read_number(buf, pos, eol)
+            total += value
+            if i in (3, 4):
+                idle += value
+        cur[0] = total - idle
+        cur[1] = total
+
+        # major minor name, reads merged sectors ms, writes merged sectors ms
+        size = self.read(1)
+        buf = self.bufs[1]
+        key = (physical_devices("/sys/block"), buf.count(b"\n", 0, size))
+        if key != self.disk_key:
+            self.disk_key = key
+            self.disk_rows = self.rows(1, size, key[0])
+        sectors = pos = row = 0
+        while pos < size:
+            eol = buf.find(b"\n", pos, size)
+            eol = size if eol < 0 else eol
+            if row in self.disk_rows:
+                # Past major and minor, then the name, which may hold digits
+                pos = read_number(buf, read_number(buf, pos, eol)[1], eol)[1]
+                pos = skip_field(buf, pos, eol)
+                for i in range(7):
+                    value, pos = read_number(buf, pos, eol)
+                    if i in (2, 6):
+                        sectors += value
+            pos = eol + 1
+            row += 1
+        cur[2] = sectors
+
+        # Two header lines, then "name: rx bytes packets ... tx bytes ..."
+        size = self.read(2)
+        buf = self.bufs[2]
+        key = (physical_devices("/sys/class/net"), buf.count(b"\n", 0, size))
+        if key != self.link_key:
+            self.link_key = key
+            self.link_rows = self.rows(2, size, key[0])
+        total = pos = row = 0
+        while pos < size:
+            eol = buf.find(b"\n", pos, size)
+            eol = size if eol < 0 else eol
+            if row in self.link_rows:
+                pos = buf.find(b":", pos, eol) + 1
+                for i in range(9):
+                    value, pos = read_number(buf, pos, eol)
+                    if i in (0, 8):
+                        total += value
+            pos = eol + 1
+            row += 1
+        cur[3] = total
+
+    def update(self, seconds: float) -> None:
+        prev, cur = self.prev, self.cur
+        jiffies = cur[1] - prev[1]
+        self.levels["cpu"] = (
+            100.0 * max(0, cur[0] - prev[0]) / jiffies if jiffies > 0 else 0.0
+        )
+        self.levels["disk"] = max(0, cur[2] - prev[2]) * SECTOR_SIZE / 1024 / seconds
+        self.levels["net"] = max(0, cur[3] - prev[3]) / 1024 / seconds
+
+        busy = quiet = False
+        for key, level in self.levels.items():
+            limit = self.thresholds[key]
+            if limit:
+                busy = busy or level >= limit
+                quiet = quiet or level >= limit / 2
+        quiet = not quiet
+
+        now = time.monotonic()
+        self.busy_samples = self.busy_samples + 1 if busy else 0
+        if self.busy_samples >= RISE_SAMPLES:
+            self.active = True
+        if not quiet:
+            self.quiet_since = None
+        elif self.quiet_since is None:
+            self.quiet_since = now
+        if (
+            self.active
+            and self.quiet_since is not None
+            and now - self.quiet_since >= self.thresholds["hold"]
+        ):
+            self.active = False
+
+    def handle(self, ready: list) -> None:
+        now = time.monotonic()
+        if now < self.next_sample:
+            return
+        self.sample()
+        self.update(now - self.last)
+        self.last = now
+        self.next_sample = now + SAMPLE_INTERVAL
+
+    def status(self) -> dict:
+        return {"activity": {k: round(v, 1) for k, v in self.levels.items()}}
+
+
+class SleepDaemon:
+    """
+    Applies the configured mode and answers JSON line requests on the
+    control socket, so sleepctl changes and status are served immediately.
+    """
+
+    def __init__(self, path: str = CONTROL_PATH) -> None:
+        self.path = path
+        self.inhibitor = Inhibitor()
+        self.watch = None
+        self.config = None
+        self.config_mtime = None
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        os.chmod(path, 0o600)
+        self.server.listen(8)
+
+    def close(self) -> None:
+        if self.watch is not None:
+            self.watch.close()
+            self.watch = None
+        self.inhibitor.close()
+        self.server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def apply(self, config: dict) -> None:
+        if config == self.config:
+            return
+        self.config = config
+        if self.watch is not None:
+            self.watch.close()
+            self.watch = None
+        mode = config["mode"]
+        log(f"Mode: {mode}")
+        if mode == "processes":
+            names = {p.strip() for p in config["processes"].split(",") if p.strip()}
+            self.watch = ProcessWatch(names)
+        elif mode == "activity":
+            try:
+                thresholds = parse_thresholds(config["activity"])
+            except ValueError as e:
+                log(f"{e}, using the default thresholds")
+                thresholds = dict(ACTIVITY_DEFAULTS)
+            self.watch = ActivityWatch(thresholds)
+        elif mode not in MODES:
+            log(f"Unknown mode '{mode}'")
+        self.update()
+
+    def update(self) -> None:
+        mode = self.config["mode"]
+        if mode not in MODES or (self.watch is not None and not self.watch.active):
+            self.inhibitor.stop()
+        else:
+            self.inhibitor.start(*MODES[mode])
+
+    def reload(self) -> None:
+        """
+        Apply the config file if it changed since it was last read.
+        """
+        try:
+            mtime = os.stat(CONFIG_PATH).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self.config_mtime or self.config is None:
+            self.config_mtime = mtime
+            self.apply(read_config())
+
+    def status(self) -> dict:
+        status = {
+            "ok": True,
+            "mode": self.config["mode"],
+            "processes": [p for p in self.config["processes"].split(",") if p.strip()],
+            "thresholds": self.config["activity"],
+            "inhibiting": self.inhibitor.fd is not None,
+            "what": self.inhibitor.what,
+            "why": self.inhibitor.why,
+            "watched": [],
+        }
+        if self.watch is not None:
+            status.update(self.watch.status())
+        return status
+
+    def request(self, request: dict) -> dict:
+        cmd = request.get("cmd")
+        if cmd == "status":
+            return self.status()
+        if cmd == "set":
+            mode = request.get("mode")
+            processes = request.get("processes") or []
+            activity = request.get("activity") or ""
+            if mode not in MODES or not isinstance(processes, list):
+                return {"ok": False, "error": f"unknown mode '{mode}'"}
+            if mode == "processes" and not processes:
+                return {"ok": False, "error": "processes mode needs a process list"}
+            try:
+                parse_thresholds(str(activity))
+            except ValueError as e:
+                return {"ok": False, "error": str(e)}
+            self.apply(
+                {
+                    "mode": mode,
+                    "processes": ",".join(map(str, processes)),
+                    "activity": str(activity),
+                }
+            )
+            return self.status()
+        return {"ok": False, "error": f"unknown command '{cmd}'"}
+
+    def handle(self, conn: socket.socket) -> None:
+        with conn:
+            conn.settimeout(1.0)
+            try:
+                _, uid, _ = PEERCRED.unpack(
+                    conn.getsockopt(
+                        socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size
+                    )
+                )
+                data = b""
+                while not data.endswith(b"\n") and len(data) < 65536:
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+                if uid not in (0, os.getuid()):
+                    reply = {"ok": False, "error": "permission denied"}
+                else:
+                    try:
+                        reply = self.request(json.loads(data))
+                    except (ValueError, AttributeError):
+                        reply = {"ok": False, "error": "malformed request"}
+                conn.sendall(json.dumps(reply).encode() + b"\n")
+            except OSError:
+                pass
+
+    def serve(self) -> None:
+        self.reload()
+        next_check = time.monotonic() + SCAN_INTERVAL
+        while True:
+            watched = [self.server]
+            timeout = max(0.0, next_check - time.monotonic())
+            if self.watch is not None:
+                watched += self.watch.fds()
+                if self.watch.timeout is not None:
+                    timeout = min(timeout, self.watch.timeout)
+            ready = select.select(watched, [], [], timeout)[0]
+            if self.server in ready:
+                conn, _ = self.server.accept()
+                self.handle(conn)
+            if self.watch is not None:
+                self.watch.handle(ready)
+            if time.monotonic() >= next_check:
+                self.reload()
+                next_check = time.monotonic() + SCAN_INTERVAL
+            self.update()
+
+
+def relay_socket() -> socket.socket:
+    """
+    The listening socket passed by sleepctl-relay.socket, or one bound here
+    when started by hand.
+    """
+    if os.environ.get("LISTEN_PID") == str(os.getpid()) and os.environ.get(
+        "LISTEN_FDS"
+    ):
+        sock = socket.socket(fileno=3)
+    else:
+        if os.path.exists(RELAY_PATH):
+            os.remove(RELAY_PATH)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sock.bind(RELAY_PATH)
+        os.chmod(RELAY_PATH, 0o666)
+        sock.listen(16)
+    sock.setblocking(False)
+    return sock
+
+
+def run_relay() -> None:
+    """
+    Forward proc connector messages to the connected user daemons. Each
+    client first sends the JSON list of process names it watches and is
+    then only sent the events about running processes with those names,
+    nothing it could not already learn from /proc.
+    A client that falls behind, or every client when the relay itself lost
+    messages, is disconnected and rescans /proc after reconnecting.
+    """
+    listener = relay_socket()
+    connector = ProcConnector()
+    try:
+        connector.sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, RELAY_BUFFER)
+    except OSError:
+        pass
+    # socket: (names, pids) once registered, None before
+    clients = {}
+    try:
+        while True:
+            ready = select.select(
+                [listener, connector] + list(clients),
+                [],
+                [],
+                None if clients else RELAY_IDLE,
+            )[0]
+            if not ready:
+                return
+            if listener in ready:
+                try:
+                    conn, _ = listener.accept()
+                    conn.setblocking(False)
+                    conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, RELAY_BUFFER)
+                    clients[conn] = None
+                except (BlockingIOError, InterruptedError):
+                    pass
+            # Clients only send their names, anything else means they hung up
+            for conn in [c for c in clients if c in ready]:
+                try:
+                    data = conn.recv(4096)
+                    if data and clients[conn] is None:
+                        names = {name[: COMM_SIZE - 1] for name in json.loads(data)}
+                        clients[conn] = (names, scan_processes(names))
+                        conn.send(RELAY_READY)
+                        continue
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except (OSError, ValueError, TypeError):
+                    pass
+                del clients[conn]
+                conn.close()
+            if connector not in ready:
+                continue
+            try:
+                messages = connector.receive()
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                for conn in clients:
+                    conn.close()
+                clients = {}
+                continue
+            for conn, watch in list(clients.items()):
+                if watch is None:
+                    continue
+                names, pids = watch
+                try:
+                    for data in messages:
+                        # Every event is applied, any one concerning the
+                        # client's processes forwards the message
+                        events = connector.parse(data)
+                        if any([follow(pids, names, *event) for event in events]):
+                            conn.send(data)
+                except OSError:
+                    del clients[conn]
+                    conn.close()
+    finally:
+        for conn in clients:
+            conn.close()
+        connector.close()
+        if os.environ.get("LISTEN_PID") != str(os.getpid()):
+            os.remove(RELAY_PATH)
+        listener.close()
+
+
+def main() -> None:
+    # Let systemd's SIGTERM unwind through the finally below
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    if sys.argv[1:] == ["--relay"]:
+        try:
+            run_relay()
+        except OSError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        except KeyboardInterrupt:
+            pass
+        return
+    daemon = SleepDaemon()
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+if __name__ == "__main__":
+    main()
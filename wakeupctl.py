@@ -1,10 +1,60 @@
 #!/usr/bin/env python3
 
+import os
+import re
 import sys
-import subprocess
 import time
+import shlex
+import fnmatch
+import fcntl
+import select
+import mmap
+import json
+import ctypes
+import socket
+import threading
+import queue
+import struct
 from pathlib import Path
 
+import bredos_sysfs as sysfs
+from bredos_uevent import UeventMonitor
+
+SYSFS = Path("/sys")
+
+# Subtrees of /sys/devices that never hold wakeup-capable devices
+PRUNE = {
+    "power",
+    "driver",
+    "subsystem",
+    "firmware_node",
+    "of_node",
+    "wakeup",
+    "msi_irqs",
+    "queue",
+    "queues",
+    "mq",
+    "holders",
+    "slaves",
+    "trace",
+    "integrity",
+    "statistics",
+    "virtual",
+    "system",
+}
+
+# linux/sockios.h and linux/ethtool.h
+SIOCETHTOOL = 0x8946
+ETHTOOL_GWOL = 0x5
+ETHTOOL_SWOL = 0x6
+WAKE_MAGIC = 1 << 5
+# struct ethtool_wolinfo, padded to the 20 bytes the kernel copies back
+WOLINFO = struct.Struct("=III6s2x")
+IFREQ_SIZE = 40
+
+# Uevent actions that can change the set of wakeup-capable devices
+HOTPLUG_ACTIONS = {"add", "remove", "move", "bind", "unbind"}
+
 
 class colors:
     endc = "\033[0m"
@@ -12,22 +62,94 @@ class colors:
     green_t = "\033[32m"
 
 
+def discover_wakeup_devices() -> list:
+    """
+    Find the power/ directories of every wakeup-capable device.
+    """
+    found = {}
+
+    wakeup_class = SYSFS / "class" / "wakeup"
+    if not wakeup_class.is_dir():
+        # Without the class, walk the device tree for power/wakeup instead
+        stack = [str(SYSFS / "devices")]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name == "power":
+                    if os.path.exists(os.path.join(entry.path, "wakeup")):
+                        found[os.path.dirname(entry.path)] = None
+                elif entry.name not in PRUNE and entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+        return [Path(device) / "power" for device in sorted(found)]
+
+    # Devices with a registered wakeup source are linked from the class
+    for source in os.scandir(wakeup_class):
+        device = os.path.join(source.path, "device")
+        if os.path.exists(os.path.join(device, "power", "wakeup")):
+            found[os.path.realpath(device)] = None
+
+    # Network adapters that can wake on LAN, whether or not it is armed
+    net = SYSFS / "class" / "net"
+    if net.is_dir():
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for link in os.scandir(net):
+                device = os.path.join(link.path, "device")
+                if not os.path.exists(os.path.join(device, "power", "wakeup")):
+                    continue
+                try:
+                    supported, _ = ethtool_wol(sock, link.name)
+                except OSError:
+                    continue
+                if supported:
+                    found[os.path.realpath(device)] = None
+
+    return [Path(device) / "power" for device in sorted(found)]
+
+
+class WakeupIndex:
+    """
+    Process lifetime cache of wakeup-capable devices, dropped only when a
+    hotplug uevent arrives.
+    """
+
+    def __init__(self) -> None:
+        self.devices = None
+        self.monitor = None
+
+    def get(self) -> list:
+        if self.monitor is None:
+            # Listen before scanning so no hotplug in between is missed
+            try:
+                self.monitor = UeventMonitor()
+            except OSError:
+                self.monitor = False
+        if self.monitor:
+            events = self.monitor.drain()
+            # Dropped uevents may have been hotplugs, so trust nothing
+            if self.monitor.lost or any(
+                event["ACTION"] in HOTPLUG_ACTIONS for event in events
+            ):
+                self.devices = None
+        elif self.monitor is False:
+            # Without uevents the cache can't be trusted across calls
+            self.devices = None
+        if self.devices is None:
+            self.devices = discover_wakeup_devices()
+        return self.devices
+
+
+wakeup_index = WakeupIndex()
+
+
 def find_power_wakeups() -> list:
-    power_paths = list(Path("/sys").rglob("power/wakeup"))
     results = []
-    for path in power_paths:
-        try:
-            state = path.read_text().strip()
-            device = path.parent
-            name = device.name
-            if (device / "uevent").exists():
-                for line in (device / "uevent").read_text().splitlines():
-                    if line.startswith("PRODUCT=") or line.startswith("PCI_ID="):
-                        name += f" ({line})"
-                        break
-            results.append((str(device), state))
-        except Exception:
-            continue
+    for path in wakeup_index.get():
+        state = sysfs.read(str(path), "wakeup")
+        if state is not None:
+            results.append((str(path), state))
     return results
 
 
@@ -56,32 +178,54 @@ def find_rtc_wakeups() -> list:
     ]
 
 
+def ethtool_wol(sock: socket.socket, ifname: str, wolopts: int | None = None) -> tuple:
+    """
+    Query (or with wolopts, set) Wake-on-LAN through the SIOCETHTOOL ioctl.
+    Returns the (supported, enabled) WAKE_* masks.
+    """
+    cmd = ETHTOOL_GWOL if wolopts is None else ETHTOOL_SWOL
+    buf = bytearray(WOLINFO.pack(cmd, 0, wolopts or 0, bytes(6)))
+    data = (ctypes.c_char * len(buf)).from_buffer(buf)
+    ifreq = struct.pack("16sP", ifname.encode(), ctypes.addressof(data))
+    fcntl.ioctl(sock, SIOCETHTOOL, ifreq.ljust(IFREQ_SIZE, b"\0"))
+    del data
+    return WOLINFO.unpack(buf)[1:3]
+
+
 def find_wol_wakeups() -> list:
     results = []
-    try:
-        links = Path("/sys/class/net").iterdir()
-        for link in links:
-            if not (link / "device").exists():
+    net = SYSFS / "class" / "net"
+    if not net.is_dir():
+        return results
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for link in sorted(os.scandir(net), key=lambda l: l.name):
+            if not os.path.exists(os.path.join(link.path, "device")):
                 continue
             try:
-                out = subprocess.check_output(
-                    ["ethtool", link.name], stderr=subprocess.DEVNULL
-                ).decode()
-                for line in out.splitlines():
-                    if "Wake-on" in line:
-                        state = line.split(":")[-1].strip()
-                        if state != "d":
-                            results.append((f"{link.name} (wol)", "enabled"))
-                        else:
-                            results.append((f"{link.name} (wol)", "disabled"))
-                        break
-            except Exception:
+                supported, enabled = ethtool_wol(sock, link.name)
+            except OSError:
                 continue
-    except Exception:
-        pass
+            if supported:
+                results.append(
+                    (f"{link.name} (wol)", "enabled" if enabled else "disabled")
+                )
     return results
 
 
+def set_wol(ifname: str, state: str) -> None:
+    """
+    Enable magic packet wake, or disable every wake option.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        supported, _ = ethtool_wol(sock, ifname)
+        if state == "enabled":
+            if not supported & WAKE_MAGIC:
+                raise OSError(f"{ifname} does not support magic packet wake")
+            ethtool_wol(sock, ifname, WAKE_MAGIC)
+        else:
+            ethtool_wol(sock, ifname, 0)
+
+
 def pf(name: str, state: str, space: int) -> None:
     if name.endswith("/power"):
         name = name[:-6]
@@ -95,20 +239,91 @@ def pf(name: str, state: str, space: int) -> None:
     )
 
 
-def get_wakeups() -> list:
-    wakeups = find_power_wakeups()
-    acpi = find_acpi_wakeups()
-    rtc = find_rtc_wakeups()
-    wol = find_wol_wakeups()
+COLLECTORS = {
+    "power": find_power_wakeups,
+    "acpi": find_acpi_wakeups,
+    "rtc": find_rtc_wakeups,
+    "wol": find_wol_wakeups,
+}
+
+
+# Seconds each collector may take before the listing goes on without it
+COLLECTOR_TIMEOUT = {"power": 5.0, "acpi": 2.0, "rtc": 2.0, "wol": 5.0}
+
 
-    return wakeups + acpi + rtc + wol
+def run_collectors(timings: dict | None = None) -> dict:
+    """
+    Run every collector concurrently, each on a daemon thread of its own so
+    one hung in a driver neither stalls the others nor holds up exit. A
+    collector that fails or runs out of time contributes no entries.
+    """
+    results = {}
+    elapsed = {}
+    # Every collection is a new run, state may have changed since the last
+    sysfs.clear()
+
+    def run(kind: str, collector) -> None:
+        start = time.perf_counter()
+        try:
+            results[kind] = collector()
+        except Exception as e:
+            results[kind] = e
+        elapsed[kind] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    threads = {
+        kind: threading.Thread(target=run, args=(kind, collector), daemon=True)
+        for kind, collector in COLLECTORS.items()
+    }
+    for thread in threads.values():
+        thread.start()
+
+    collected = {}
+    for kind, thread in threads.items():
+        thread.join(max(0.0, start + COLLECTOR_TIMEOUT[kind] - time.perf_counter()))
+        result = results.get(kind)
+        if thread.is_alive():
+            status = "timeout"
+            print(
+                f"Warning: {kind} collector timed out after {COLLECTOR_TIMEOUT[kind]}s",
+                file=sys.stderr,
+            )
+        elif isinstance(result, Exception):
+            status = "error"
+            print(f"Warning: {kind} collector failed -> {result}", file=sys.stderr)
+        else:
+            status = "ok"
+        collected[kind] = result if status == "ok" else []
+        if timings is not None:
+            timings[kind] = (elapsed.get(kind, time.perf_counter() - start), status)
+    return collected
 
 
-def list_wakeups() -> None:
-    wakeups = find_power_wakeups()
-    acpi = find_acpi_wakeups()
-    rtc = find_rtc_wakeups()
-    wol = find_wol_wakeups()
+def collect_wakeups(direct: bool = False, timings: dict | None = None) -> dict:
+    """
+    Entries of every collector, from the daemon when one is running.
+    """
+    if not direct:
+        start = time.perf_counter()
+        reply = daemon_request({"cmd": "list"})
+        if reply is not None and reply.get("ok"):
+            if timings is not None:
+                timings["daemon"] = (time.perf_counter() - start, "ok")
+            return {
+                kind: [tuple(entry) for entry in entries]
+                for kind, entries in reply["wakeups"].items()
+            }
+    return run_collectors(timings)
+
+
+def get_wakeups(direct: bool = False) -> list:
+    return [entry for entries in collect_wakeups(direct).values() for entry in entries]
+
+
+def list_wakeups(timings: bool = False) -> None:
+    elapsed = {} if timings else None
+    collected = collect_wakeups(timings=elapsed)
+    wakeups, acpi, rtc, wol = (collected[kind] for kind in COLLECTORS)
 
     maxl = max([len(str(d)) for d, _ in wakeups + acpi + rtc + wol] + [5])
 
@@ -131,90 +346,942 @@ def list_wakeups() -> None:
         for name, state in wol:
             pf(name, state, maxl)
 
+    if timings:
+        print("\n== Collector timings:")
+        for kind, (seconds, status) in elapsed.items():
+            note = "" if status == "ok" else f"  ({status})"
+            print(f"{kind:<8} {seconds * 1000:9.2f}ms{note}")
 
-def set_wakeup(targets: list, state: str) -> None:
+
+def write_state(name: str, state: str) -> None:
+    """
+    Set one entry, as named by get_wakeups(), to enabled or disabled.
+    """
+    if name.endswith(" (wol)"):
+        set_wol(name.removesuffix(" (wol)"), state)
+    elif name.endswith("/power"):
+        with open(f"{name}/wakeup", "w") as f:
+            f.write(state)
+    elif name == "rtc":
+        raise OSError("the RTC alarm is not switched through wakeupctl")
+    else:
+        # /proc/acpi/wakeup toggles the named device on every write
+        if dict(find_acpi_wakeups()).get(name) != state:
+            with open("/proc/acpi/wakeup", "w") as f:
+                f.write(name)
+
+
+def set_matching(wakeups: list, targets: list, state: str) -> dict:
+    """
+    Set every entry whose name contains a target.
+    Returns each target's [(name, error or None), ...].
+    """
+    results = {}
     for target in targets:
-        target = target.lower()
-        matches = set()
+        matches = {name for name, _ in wakeups if target.lower() in name.lower()}
+        results[target] = []
+        for name in sorted(matches):
+            try:
+                write_state(name, state)
+                results[target].append((name, None))
+            except Exception as e:
+                results[target].append((name, str(e)))
+    return results
 
-        wakeups = get_wakeups()
 
-        for name, _ in wakeups:
-            if target in name:
-                matches.add(name)
+def set_wakeup(targets: list, state: str) -> None:
+    reply = daemon_request(
+        {"cmd": "set", "targets": targets, "state": state}, UPDATE_TIMEOUT
+    )
+    if reply is None:
+        results = set_matching(get_wakeups(direct=True), targets, state)
+    elif not reply.get("ok"):
+        print(f"Error: {reply.get('error')}", file=sys.stderr)
+        return
+    else:
+        results = reply["results"]
 
-        if not matches:
+    for target, outcome in results.items():
+        if not outcome:
             print(f"No device matched '{target}'")
-        else:
-            for name in matches:
-                try:
-                    with open(f"{name}/wakeup", "w") as f:
-                        f.write(state)
-                    print(f"{name}: set to {state}")
-                except Exception as e:
-                    print(f"{name}: failed to set -> {e}")
+        for name, error in outcome:
+            if error is None:
+                print(f"{name}: set to {state}")
+            else:
+                print(f"{name}: failed to set -> {error}")
 
 
-def get_active_counts() -> dict:
-    results = {}
-    wakeups = get_wakeups()
+POLICY_FILE = "/etc/bredos/wakeup.conf"
+POLICY_KEYS = ("name", "subsystem", "driver", "id", "state")
 
-    for name, state in wakeups:
-        if state == "enabled":
-            event_file = f"{name}/wakeup_active_count"
-            if not Path(event_file).exists():
+
+def compile_pattern(pattern: str) -> re.Pattern:
+    """
+    /regex/ is searched as is, anything else is a shell glob over the whole value.
+    """
+    if len(pattern) > 1 and pattern.startswith("/") and pattern.endswith("/"):
+        return re.compile(pattern[1:-1])
+    return re.compile("^" + fnmatch.translate(pattern))
+
+
+def load_policy(path: str) -> list:
+    """
+    Parse a policy file into (state, [(key, pattern), ...]) rules.
+    Each line is a target state followed by KEY=PATTERN matches, all of
+    which have to hold for the rule to apply.
+    """
+    rules = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            try:
+                words = shlex.split(line, comments=True)
+            except ValueError as e:
+                raise ValueError(f"{path}:{lineno}: {e}")
+            if not words:
                 continue
+            state, matches = words[0], []
+            if state not in ("enabled", "disabled"):
+                raise ValueError(f"{path}:{lineno}: unknown state '{state}'")
+            for word in words[1:]:
+                key, sep, pattern = word.partition("=")
+                if not sep or key not in POLICY_KEYS:
+                    raise ValueError(f"{path}:{lineno}: bad match '{word}'")
+                try:
+                    matches.append((key, compile_pattern(pattern)))
+                except re.error as e:
+                    raise ValueError(f"{path}:{lineno}: {e}")
+            if not matches:
+                raise ValueError(f"{path}:{lineno}: rule matches nothing")
+            rules.append((state, matches))
+    return rules
+
+
+def device_id(device: str) -> str:
+    """
+    vendor:product of a USB or PCI device, in lowercase hex.
+    """
+    uevent = sysfs.read(device, "uevent")
+    if uevent is None:
+        return ""
+    uevent = dict(line.partition("=")[::2] for line in uevent.splitlines())
+    if "PRODUCT" in uevent and uevent.get("DEVTYPE") == "usb_device":
+        vendor, product = uevent["PRODUCT"].split("/")[:2]
+        return f"{int(vendor, 16):04x}:{int(product, 16):04x}"
+    return uevent.get("PCI_ID", "").lower()
+
+
+def wakeup_attributes(name: str, state: str) -> dict:
+    """
+    Everything a policy rule can match on for one get_wakeups() entry.
+    """
+    attrs = {"name": name.removesuffix("/power"), "state": state}
+    if name.endswith("/power"):
+        device = attrs["name"]
+    elif name.endswith(" (wol)"):
+        device = str(SYSFS / "class" / "net" / name.removesuffix(" (wol)") / "device")
+    else:
+        attrs.update(subsystem="rtc" if name == "rtc" else "acpi", driver="", id="")
+        return attrs
+    attrs["subsystem"] = sysfs.link(device, "subsystem") or ""
+    attrs["driver"] = sysfs.link(device, "driver") or ""
+    attrs["id"] = device_id(device)
+    return attrs
+
+
+def apply_policy(path: str, dry_run: bool = False) -> bool:
+    """
+    Evaluate every rule against a single scan, the last matching rule wins.
+    """
+    try:
+        rules = load_policy(path)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return False
+
+    # Straight from sysfs, the daemon's model may lag behind ACPI and WoL
+    changes = []
+    for name, state in get_wakeups(direct=True):
+        attrs = wakeup_attributes(name, state)
+        wanted = state
+        for rule_state, matches in rules:
+            if all(pattern.search(attrs[key]) for key, pattern in matches):
+                wanted = rule_state
+        if wanted != state:
+            changes.append((name, state, wanted))
+
+    if not changes:
+        print("Policy already in effect")
+        return True
+
+    ok = True
+    maxl = max(len(name.removesuffix("/power")) for name, _, _ in changes)
+    for name, state, wanted in changes:
+        shown = name.removesuffix("/power")
+        line = f"{shown}{' ' * (maxl - len(shown))} : {state} -> {wanted}"
+        if dry_run:
+            print(line)
+            continue
+        try:
+            write_state(name, wanted)
+            print(line)
+        except Exception as e:
+            print(f"{line} failed -> {e}")
+            ok = False
+    if dry_run:
+        print(f"\n{len(changes)} change(s), nothing applied (dry run)")
+    else:
+        daemon_request({"cmd": "rescan"}, UPDATE_TIMEOUT)
+    return ok
+
+
+class WakeupCounters:
+    """
+    Counter files of every registered wakeup source, opened once and
+    re-read in place with pread on each tick.
+    """
+
+    COUNTERS = ("event_count", "wakeup_count", "active_count")
+
+    def __init__(self, counters: tuple = COUNTERS) -> None:
+        self.counters = counters
+        self.sources = {}
+        self.refresh()
+
+    def close(self) -> None:
+        for fds in self.sources.values():
+            for fd in fds:
+                os.close(fd)
+        self.sources = {}
+
+    def refresh(self) -> None:
+        self.close()
+        wakeup_class = SYSFS / "class" / "wakeup"
+        if not wakeup_class.is_dir():
+            return
+        for source in os.scandir(wakeup_class):
+            device = os.path.join(source.path, "device")
+            if os.path.exists(device):
+                # Named like find_power_wakeups() so set_wakeup() accepts it
+                key = os.path.join(os.path.realpath(device), "power")
+            else:
+                key = sysfs.read(source.path, "name") or source.name
+            fds = []
+            for counter in self.counters:
+                try:
+                    fds.append(
+                        os.open(
+                            os.path.join(source.path, counter),
+                            os.O_RDONLY | os.O_CLOEXEC,
+                        )
+                    )
+                except OSError:
+                    break
+            if len(fds) == len(self.counters):
+                self.sources[key] = fds
+            else:
+                for fd in fds:
+                    os.close(fd)
+
+    def read(self) -> dict:
+        results = {}
+        for key, fds in self.sources.items():
             try:
-                with open(event_file) as f:
-                    count = int(f.read().strip())
-                    results[name] = count
-            except Exception:
+                results[key] = tuple(int(os.pread(fd, 32, 0)) for fd in fds)
+            except (OSError, ValueError):
                 continue
-    return results
+        return results
 
 
-def monitor_wakeups(disable: False) -> None:
+def monitor_wakeups(
+    disable: bool = False, interval: float = 0.2, max_interval: float = 2.0
+) -> None:
+    """
+    Report wakeup source counter changes. The poll interval starts at
+    interval and backs off towards max_interval while nothing happens.
+    """
     print("== Monitoring enabled wakeup event counts.\n== Ctrl+C to exit.\n")
-    prev = get_active_counts()
+    counters = WakeupCounters()
+    try:
+        monitor = UeventMonitor(subsystems={"wakeup"})
+    except OSError:
+        monitor = None
+    prev = counters.read()
+    delay = interval
     try:
         while True:
-            time.sleep(0.2)
-            now = get_active_counts()
-            for key in now:
-                if key in prev and now[key] != prev[key]:
-                    print(f"{key}: {prev[key]} -> {now[key]}")
-                    if disable:
-                        set_wakeup(key, "disabled")
+            if monitor is not None:
+                if monitor.poll(delay) or monitor.lost:
+                    counters.refresh()
+            else:
+                time.sleep(delay)
+            now = counters.read()
+            changed = False
+            for key, values in now.items():
+                before = prev.get(key)
+                if before is None or before == values:
+                    continue
+                changed = True
+                deltas = ", ".join(
+                    f"{name} {old} -> {new}"
+                    for name, old, new in zip(WakeupCounters.COUNTERS, before, values)
+                    if old != new
+                )
+                print(f"{key.removesuffix('/power')}: {deltas}")
+                if disable and key.endswith("/power"):
+                    set_wakeup([key], "disabled")
             prev = now
+            delay = interval if changed else min(delay * 2, max_interval)
     except KeyboardInterrupt:
         print("\r\033[K\n" + ("-" * 8) + "\nMonitoring finished")
+    finally:
+        counters.close()
+        if monitor is not None:
+            monitor.close()
+
+
+RECORD_FILE = "/var/lib/bredos/wakeup.rec"
+STATS = (
+    "wakeup_count",
+    "active_count",
+    "total_time_ms",
+    "max_time_ms",
+    "last_change_ms",
+)
+
+
+class WakeupRecording:
+    """
+    Fixed-size ring buffer file of wakeup source samples.
+
+    A header is followed by a table of source names and then capacity
+    records, each one source's STATS at one point in time. The file is
+    mmapped, so neither disk nor memory use grows with recording length.
+    """
+
+    MAGIC = b"BRWAKEUP"
+    VERSION = 1
+    # magic, version, sources, max_sources, capacity, written, last sample
+    HEADER = struct.Struct("<8sHHIIQd")
+    NAME_SIZE = 96
+    # time, source index, STATS
+    RECORD = struct.Struct("<dI4x5Q")
+
+    def __init__(self, path: str, writable: bool = False) -> None:
+        self.file = open(path, "r+b" if writable else "rb")
+        try:
+            self.map = mmap.mmap(
+                self.file.fileno(),
+                0,
+                access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ,
+            )
+        except ValueError:
+            self.file.close()
+            raise ValueError(f"{path} is not a wakeup recording")
+        (
+            magic,
+            version,
+            sources,
+            self.max_sources,
+            self.capacity,
+            self.written,
+            self.last,
+        ) = self.HEADER.unpack_from(self.map)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a wakeup recording")
+        self.names = []
+        for i in range(sources):
+            offset = self.HEADER.size + i * self.NAME_SIZE
+            name = self.map[offset : offset + self.NAME_SIZE].rstrip(b"\0")
+            self.names.append(name.decode(errors="replace"))
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.records_at = self.HEADER.size + self.max_sources * self.NAME_SIZE
+
+    @classmethod
+    def create(cls, path: str, capacity: int, max_sources: int = 256) -> None:
+        size = cls.HEADER.size + max_sources * cls.NAME_SIZE
+        size += capacity * cls.RECORD.size
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wb") as f:
+            f.truncate(size)
+            f.write(
+                cls.HEADER.pack(cls.MAGIC, cls.VERSION, 0, max_sources, capacity, 0, 0)
+            )
+
+    def __enter__(self) -> "WakeupRecording":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if not self.map.closed:
+            self.map.close()
+        self.file.close()
+
+    def source(self, name: str) -> int | None:
+        """
+        Index of name in the source table, adding it if there is room.
+        """
+        if name in self.index:
+            return self.index[name]
+        if len(self.names) >= self.max_sources:
+            return None
+        offset = self.HEADER.size + len(self.names) * self.NAME_SIZE
+        self.map[offset : offset + self.NAME_SIZE] = name.encode()[
+            : self.NAME_SIZE
+        ].ljust(self.NAME_SIZE, b"\0")
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        return self.index[name]
+
+    def append(self, when: float, source: int, values: tuple) -> None:
+        slot = self.written % self.capacity
+        self.RECORD.pack_into(
+            self.map, self.records_at + slot * self.RECORD.size, when, source, *values
+        )
+        self.written += 1
+
+    def sync(self, when: float) -> None:
+        """
+        Store the header, marking when the last sample was taken.
+        """
+        self.last = when
+        self.HEADER.pack_into(
+            self.map,
+            0,
+            self.MAGIC,
+            self.VERSION,
+            len(self.names),
+            self.max_sources,
+            self.capacity,
+            self.written,
+            self.last,
+        )
+
+    def records(self):
+        """
+        Yield (time, source, values) from oldest to newest.
+        """
+        count = min(self.written, self.capacity)
+        first = self.written - count
+        for n in range(first, self.written):
+            offset = self.records_at + (n % self.capacity) * self.RECORD.size
+            when, source, *values = self.RECORD.unpack_from(self.map, offset)
+            yield when, source, values
+
+
+def source_name(key: str) -> str:
+    """
+    Short stable name for a WakeupCounters key.
+    """
+    devices = str(SYSFS / "devices") + "/"
+    return key.removesuffix("/power").removeprefix(devices)
+
+
+def record_wakeups(path: str, interval: float = 60.0, capacity: int = 65536) -> None:
+    """
+    Sample every wakeup source into a recording, storing a source only when
+    one of its counters moved (and all of them once on start).
+    """
+    if not os.path.exists(path):
+        WakeupRecording.create(path, capacity)
+    counters = WakeupCounters(STATS)
+    try:
+        monitor = UeventMonitor(subsystems={"wakeup"})
+    except OSError:
+        monitor = None
+    full = False
+    print(
+        f"== Recording wakeup statistics to {path} every {interval}s.\n== Ctrl+C to exit.\n"
+    )
+    try:
+        with WakeupRecording(path, writable=True) as recording:
+            prev = {}
+            try:
+                while True:
+                    if monitor is not None and (monitor.drain() or monitor.lost):
+                        counters.refresh()
+                    now = time.time()
+                    current = counters.read()
+                    for key, values in current.items():
+                        if prev.get(key) == values:
+                            continue
+                        source = recording.source(source_name(key))
+                        if source is None:
+                            if not full:
+                                print("Source table full, new sources are not recorded")
+                                full = True
+                            continue
+                        recording.append(now, source, values)
+                    recording.sync(now)
+                    prev = current
+                    time.sleep(interval)
+            except KeyboardInterrupt:
+                print("\r\033[K\n" + ("-" * 8) + "\nRecording stopped")
+            finally:
+                recording.map.flush()
+    finally:
+        counters.close()
+        if monitor is not None:
+            monitor.close()
+
+
+def parse_duration(text: str) -> float:
+    """
+    Seconds in "90", "15m", "24h" or "7d".
+    """
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def wakeup_report(path: str, window: float | None = None) -> tuple[list, float]:
+    """
+    Per-source wakeups and active time over the last window seconds of a
+    recording (all of it by default). Returns the rows and the covered span.
+    """
+    with WakeupRecording(path) as recording:
+        records = list(recording.records())
+        names = recording.names
+        end = recording.last
+    if not records:
+        return [], 0.0
+    start = records[0][0]
+    if window is not None:
+        start = max(start, end - window)
+
+    totals = {}
+    prev = {}
+    for when, source, values in records:
+        before = prev.get(source)
+        prev[source] = values
+        if before is None or when < start:
+            continue
+        # Counters restart from zero after a reboot
+        if any(new < old for old, new in zip(before, values)):
+            before = (0,) * len(values)
+        entry = totals.setdefault(source, [0, 0, 0])
+        entry[0] += values[0] - before[0]
+        entry[1] += values[2] - before[2]
+        entry[2] = max(entry[2], values[3])
+
+    span = max(end - start, 1.0)
+    rows = [
+        {
+            "source": names[source] if source < len(names) else f"#{source}",
+            "wakeups": wakeups,
+            "wakeups_per_hour": wakeups * 3600 / span,
+            "active_ms": active,
+            "active_percent": active / 10 / span,
+            "max_ms": longest,
+        }
+        for source, (wakeups, active, longest) in totals.items()
+    ]
+    rows.sort(key=lambda r: (-r["wakeups_per_hour"], -r["active_ms"]))
+    return rows, span
+
+
+def print_report(rows: list, span: float, top: int | None = None) -> None:
+    shown = f"{span / 3600:.1f}h" if span >= 3600 else f"{span / 60:.1f}m"
+    print(f"== Wakeup sources over the last {shown}:\n")
+    if not rows:
+        print("No wakeup activity recorded")
+        return
+    rows = rows[:top] if top else rows
+    width = max([len(r["source"]) for r in rows] + [6])
+    print(
+        f"{'SOURCE':<{width}}  {'WAKEUPS':>8}  {'PER HOUR':>9}  "
+        f"{'ACTIVE':>10}  {'ACTIVE%':>7}  {'MAX':>9}"
+    )
+    for r in rows:
+        print(
+            f"{r['source']:<{width}}  {r['wakeups']:>8}  {r['wakeups_per_hour']:>9.2f}  "
+            f"{r['active_ms'] / 1000:>9.1f}s  {r['active_percent']:>6.2f}%  "
+            f"{r['max_ms'] / 1000:>8.1f}s"
+        )
+
+
+SOCKET_PATH = os.environ.get("WAKEUPCTL_SOCKET", "/run/wakeupctl.sock")
+# Changes to ACPI and Wake-on-LAN state raise no uevents, rescan this often
+RESYNC_INTERVAL = 60.0
+PEERCRED = struct.Struct("3i")
+# Clients get this long to send a request and read the reply
+CLIENT_TIMEOUT = 5.0
+# set and rescan reply only after the collectors have run again
+UPDATE_TIMEOUT = CLIENT_TIMEOUT + max(COLLECTOR_TIMEOUT.values())
+MAX_CLIENTS = 64
+REQUEST_SIZE = 65536
+
+
+def daemon_request(request: dict, timeout: float = 2.0) -> dict | None:
+    """
+    Send one request to a running daemon, None when there is none.
+    """
+    # The daemon serves the live system, not a tree under --sysfs-root
+    if sysfs.ROOT != "/sys" or not os.path.exists(SOCKET_PATH):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(SOCKET_PATH)
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            data = b""
+            while not data.endswith(b"\n"):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        return json.loads(data)
+    except (OSError, ValueError):
+        return None
+
+
+class WakeupDaemon:
+    """
+    In-memory model of every wake source, rescanned on hotplug uevents and
+    served as JSON lines over a unix socket. Anyone may list and get, only
+    root may set and rescan.
+
+    Connections are served from the same select loop as the uevents, a
+    client that stalls only holds its own slot until CLIENT_TIMEOUT.
+    Collection runs on a worker thread so list and get keep being answered
+    meanwhile; set and rescan clients get their reply once it finishes.
+    """
+
+    def __init__(self, path: str = SOCKET_PATH) -> None:
+        self.path = path
+        try:
+            self.monitor = UeventMonitor()
+        except OSError:
+            self.monitor = None
+        self.model = collect_wakeups(direct=True)
+        self.synced = time.monotonic()
+        # (socket or None, reply, set request or None) for the worker
+        self.jobs = queue.Queue()
+        # (socket or None, reply, model) back from it, signalled on wakeup
+        self.done = queue.Queue()
+        self.wakeup, self.notify = socket.socketpair()
+        self.wakeup.setblocking(False)
+        threading.Thread(target=self.work, daemon=True).start()
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        os.chmod(path, 0o666)
+        self.server.listen(16)
+        self.server.setblocking(False)
+        # socket: [uid, request bytes, reply bytes, deadline], the request
+        # and deadline are None while the worker has its reply
+        self.clients = {}
+
+    def close(self) -> None:
+        for conn in self.clients:
+            conn.close()
+        self.clients = {}
+        self.server.close()
+        self.wakeup.close()
+        self.notify.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if self.monitor is not None:
+            self.monitor.close()
+
+    def rescan(self, conn: socket.socket | None = None, change=None) -> None:
+        """
+        Queue a collection, applying a (wakeups, targets, state) change first.
+        """
+        self.synced = time.monotonic()
+        self.jobs.put((conn, {"ok": True}, change))
+
+    def work(self) -> None:
+        while True:
+            conn, reply, change = self.jobs.get()
+            # Every job ends in a collection, a plain rescan queued before
+            # another job adds nothing
+            if conn is None and change is None and not self.jobs.empty():
+                continue
+            if change is not None:
+                reply = {"ok": True, "results": set_matching(*change)}
+            self.done.put((conn, reply, collect_wakeups(direct=True)))
+            try:
+                self.notify.send(b"\0")
+            except OSError:
+                return
+
+    def finish(self) -> None:
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while not self.done.empty():
+            conn, reply, self.model = self.done.get()
+            self.synced = time.monotonic()
+            if conn in self.clients:
+                client = self.clients[conn]
+                client[2] = json.dumps(reply).encode() + b"\n"
+                client[3] = time.monotonic() + CLIENT_TIMEOUT
+                self.send(conn)
+
+    def request(self, request: dict, uid: int) -> dict | tuple:
+        """
+        The reply, or for work left to the worker the change to apply
+        (empty for a plain rescan).
+        """
+        cmd = request.get("cmd")
+        if cmd == "list":
+            return {"ok": True, "wakeups": self.model}
+        if cmd == "get":
+            name = str(request.get("name", "")).lower()
+            return {
+                "ok": True,
+                "wakeups": [
+                    entry
+                    for entries in self.model.values()
+                    for entry in entries
+                    if name in entry[0].lower()
+                ],
+            }
+        if cmd == "set":
+            if uid != 0:
+                return {"ok": False, "error": "only root may change wake sources"}
+            state = request.get("state")
+            targets = request.get("targets")
+            if state not in ("enabled", "disabled") or not isinstance(targets, list):
+                return {"ok": False, "error": "set needs targets and a state"}
+            wakeups = [entry for entries in self.model.values() for entry in entries]
+            return (wakeups, [str(t) for t in targets], state)
+        if cmd == "rescan":
+            # ACPI and Wake-on-LAN changes made elsewhere raise no uevent
+            if uid != 0:
+                return {"ok": False, "error": "only root may request a rescan"}
+            return ()
+        return {"ok": False, "error": f"unknown command '{cmd}'"}
+
+    def accept(self) -> None:
+        try:
+            conn, _ = self.server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        if len(self.clients) >= MAX_CLIENTS:
+            conn.close()
+            return
+        try:
+            _, uid, _ = PEERCRED.unpack(
+                conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size)
+            )
+        except OSError:
+            conn.close()
+            return
+        conn.setblocking(False)
+        self.clients[conn] = [uid, b"", b"", time.monotonic() + CLIENT_TIMEOUT]
+
+    def drop(self, conn: socket.socket) -> None:
+        del self.clients[conn]
+        conn.close()
+
+    def receive(self, conn: socket.socket) -> None:
+        client = self.clients[conn]
+        try:
+            chunk = conn.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.drop(conn)
+            return
+        client[1] += chunk
+        if chunk and not client[1].endswith(b"\n") and len(client[1]) < REQUEST_SIZE:
+            return
+        if not client[1]:
+            self.drop(conn)
+            return
+        try:
+            reply = self.request(json.loads(client[1]), client[0])
+        except (ValueError, AttributeError):
+            reply = {"ok": False, "error": "malformed request"}
+        if isinstance(reply, tuple):
+            # Answered by the worker, the client waits without a deadline
+            self.rescan(conn, reply or None)
+            client[1] = None
+            client[3] = None
+            return
+        client[2] = json.dumps(reply).encode() + b"\n"
+        self.send(conn)
+
+    def send(self, conn: socket.socket) -> None:
+        client = self.clients[conn]
+        try:
+            sent = conn.send(client[2])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.drop(conn)
+            return
+        client[2] = client[2][sent:]
+        if not client[2]:
+            self.drop(conn)
+
+    def serve(self) -> None:
+        while True:
+            now = time.monotonic()
+            for conn, client in list(self.clients.items()):
+                if client[3] is not None and client[3] <= now:
+                    self.drop(conn)
+            timeout = max(0.0, self.synced + RESYNC_INTERVAL - now)
+            deadlines = [c[3] for c in self.clients.values() if c[3] is not None]
+            if deadlines:
+                timeout = min(timeout, max(0.0, min(deadlines) - now))
+            reading = [self.server, self.wakeup]
+            reading += [self.monitor] if self.monitor else []
+            reading += [
+                conn
+                for conn, client in self.clients.items()
+                if client[1] is not None and not client[2]
+            ]
+            writing = [conn for conn, client in self.clients.items() if client[2]]
+            readable, writable, _ = select.select(reading, writing, [], timeout)
+            if self.wakeup in readable:
+                self.finish()
+            if self.monitor in readable:
+                events = self.monitor.drain()
+                if self.monitor.lost or any(
+                    event["ACTION"] in HOTPLUG_ACTIONS for event in events
+                ):
+                    self.rescan()
+            elif time.monotonic() >= self.synced + RESYNC_INTERVAL:
+                self.rescan()
+            for conn in writable:
+                if conn in self.clients:
+                    self.send(conn)
+            for conn in readable:
+                if conn is self.server:
+                    self.accept()
+                elif conn in self.clients:
+                    self.receive(conn)
+
+
+def run_daemon() -> None:
+    daemon = WakeupDaemon()
+    print(f"== Serving wake sources on {daemon.path}")
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+def option(args: list, names: list, default: str) -> str:
+    """
+    Value following any of names in args, or default.
+    """
+    for i, arg in enumerate(args[:-1]):
+        if arg in names:
+            return args[i + 1]
+    return default
 
 
 def main() -> None:
+    global SYSFS
     args = sys.argv[1:]
-    print("BredOS Wakeup device trigger handler\n" + (36 * "-") + "\n")
-    if not args:
-        list_wakeups()
+    if "--sysfs-root" in args[:-1]:
+        i = args.index("--sysfs-root")
+        sysfs.set_root(args[i + 1])
+        SYSFS = Path(sysfs.ROOT)
+        del args[i : i + 2]
+    if "--json" not in args:
+        print("BredOS Wakeup device trigger handler\n" + (36 * "-") + "\n")
+    if not args or args == ["--timings"]:
+        list_wakeups("--timings" in args)
         print("\n" + ("-" * 13) + "\nEND OF REPORT")
     elif args[0] in ["-m", "--monitor"]:
-        monitor_wakeups((len(args) - 1) and (args[1] in ["-a", "--autodisable"]))
+        try:
+            interval = float(option(args, ["-i", "--interval"], "0.2"))
+            max_interval = float(option(args, ["--max-interval"], "2.0"))
+        except ValueError:
+            print("Intervals must be numbers of seconds!")
+            sys.exit(1)
+        monitor_wakeups(
+            any(arg in ["-a", "--autodisable"] for arg in args[1:]),
+            interval,
+            max(interval, max_interval),
+        )
     elif args[0] in ["-d", "--disable"]:
         if not len(args) - 1:
             print("No devices specified!")
         else:
-            set_wakeup(args[2:], "disabled")
+            set_wakeup(args[1:], "disabled")
     elif args[0] in ["-e", "--enable"]:
         if not len(args) - 1:
             print("No devices specified!")
         else:
-            set_wakeup(args[2:], "enabled")
+            set_wakeup(args[1:], "enabled")
+    elif args[0] in ["-D", "--daemon"]:
+        try:
+            run_daemon()
+        except OSError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+    elif args[0] in ["--record"]:
+        path = args[1] if len(args) > 1 and not args[1].startswith("-") else RECORD_FILE
+        try:
+            interval = float(option(args, ["-i", "--interval"], "60"))
+            capacity = int(option(args, ["--capacity"], "65536"))
+        except ValueError:
+            print("Interval and capacity must be numbers!")
+            sys.exit(1)
+        try:
+            record_wakeups(path, interval, capacity)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+    elif args[0] in ["report", "--report"]:
+        path = args[1] if len(args) > 1 and not args[1].startswith("-") else RECORD_FILE
+        try:
+            window = option(args, ["-w", "--window"], None)
+            window = parse_duration(window) if window else None
+            top = int(option(args, ["-n", "--top"], "0"))
+        except ValueError:
+            print("Bad --window or --top value!")
+            sys.exit(1)
+        try:
+            rows, span = wakeup_report(path, window)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        if "--json" in args:
+            json.dump(
+                {"span": span, "sources": rows[:top] if top else rows},
+                sys.stdout,
+                indent=2,
+            )
+            print()
+        else:
+            print_report(rows, span, top)
+    elif args[0] in ["-p", "--policy"]:
+        path = args[1] if len(args) > 1 and not args[1].startswith("-") else POLICY_FILE
+        if not apply_policy(path, "--dry-run" in args[1:]):
+            sys.exit(1)
     else:
         print(
             "Usage:\n  bredos-wakeupctl"
             + (" " * 15)
-            + "# List all wake sources\n  bredos-wakeupctl usb enabled"
+            + "# List all wake sources\n  bredos-wakeupctl --timings"
+            + "            # ...with per-collector latency\n  bredos-wakeupctl usb enabled"
             + "   # Set USB-related wakeups to enabled\n  bredos-wakeupctl --monitor"
-            + "          # Monitor active wakeups"
+            + "          # Monitor active wakeups\n"
+            + "    [-a|--autodisable] [-i|--interval SECONDS] [--max-interval SECONDS]\n"
+            + "  bredos-wakeupctl --policy [FILE] [--dry-run]\n"
+            + "                                 # Apply the rules in "
+            + POLICY_FILE
+            + "\n  bredos-wakeupctl --record [FILE] [-i SECONDS] [--capacity RECORDS]\n"
+            + "  bredos-wakeupctl report [FILE] [-w|--window 24h] [-n|--top N] [--json]\n"
+            + "  bredos-wakeupctl --daemon       # Serve wake sources on "
+            + SOCKET_PATH
+            + "\n\n  --sysfs-root PATH may be given with any of these to read a"
+            + " captured or fake sysfs"
         )
 
 